@@ -0,0 +1,202 @@
+# analytics_archive.py
+# Moves monthly analytics partitions older than the retention horizon out of
+# the tenant databases into gzip-JSONL files (one per database and month),
+# and reads them back for exports. Rollups keep the archived months' counts,
+# so dashboards do not change when a month is archived.
+#
+#   python analytics_archive.py archive                    # months older than ANALYTICS_RETENTION_MONTHS
+#   python analytics_archive.py archive --retention-months 6 --vacuum
+#   python analytics_archive.py export CLIENT_ID --since 2024-01-01 > events.jsonl
+import argparse
+import gzip
+import heapq
+import json
+import os
+import re
+import sys
+from datetime import datetime
+from db import (DB_FILE, ANALYTICS_COLUMNS, ANALYTICS_EVENT_COLUMNS, PooledConnection, get_pool, tenant_db_file,
+                tenant_db_files, analytics_partition_table, drop_analytics_partition)
+
+# Whole months kept in the database besides the current one
+ANALYTICS_RETENTION_MONTHS = int(os.getenv("ANALYTICS_RETENTION_MONTHS", "12"))
+ANALYTICS_ARCHIVE_DIR = (os.getenv("ANALYTICS_ARCHIVE_DIR")
+                         or os.path.join(os.path.dirname(os.path.abspath(DB_FILE)), "analytics_archive"))
+
+# {database file stem}_{month}[.n].jsonl.gz; every shard archives into the same directory
+_ARCHIVE_NAME = re.compile(r"^(.+)_(\d{4}-\d{2})(?:\.\d+)?\.jsonl\.gz$")
+
+
+def retention_cutoff(retention_months=ANALYTICS_RETENTION_MONTHS, now=None):
+    """First month ('YYYY-MM') that is kept; everything before it is archived."""
+    now = now or datetime.utcnow()
+    index = now.year * 12 + now.month - 1 - max(0, retention_months)
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+
+def _archive_stem(db_path):
+    return os.path.splitext(os.path.basename(db_path))[0]
+
+
+def _archive_path(archive_dir, db_path, month):
+    stem = _archive_stem(db_path)
+    path = os.path.join(archive_dir, f"{stem}_{month}.jsonl.gz")
+    n = 1
+    # A month re-opened by late events is archived again next to the first file
+    while os.path.exists(path):
+        n += 1
+        path = os.path.join(archive_dir, f"{stem}_{month}.{n}.jsonl.gz")
+    return path
+
+
+# ----------------------------
+# Archiving
+# ----------------------------
+def archive_month(db_path, month, archive_dir=ANALYTICS_ARCHIVE_DIR):
+    """
+    Writes one partition to a gzip-JSONL file, sorted by (client_id, timestamp, id),
+    then drops it. Returns the file, or None if rows arrived while it was written
+    (the month is left alone and retried on the next run).
+    """
+    table = analytics_partition_table(month)
+    os.makedirs(archive_dir, exist_ok=True)
+    target = _archive_path(archive_dir, db_path, month)
+    tmp = target + ".tmp"
+
+    conn = PooledConnection(get_pool(db_path))
+    try:
+        written = 0
+        # The dump is a plain read: in WAL mode, writers are not blocked meanwhile
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            for row in conn.execute(f"SELECT {', '.join(ANALYTICS_COLUMNS)} FROM {table} "
+                                    "ORDER BY client_id, timestamp, id"):
+                f.write(json.dumps(dict(row)) + "\n")
+                written += 1
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] != written:
+                conn.rollback()
+                os.remove(tmp)
+                return None
+            os.replace(tmp, target)
+            drop_analytics_partition(conn, db_path, month, archive_path=target)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    finally:
+        conn.close()
+    return target
+
+
+def archive_expired(retention_months=ANALYTICS_RETENTION_MONTHS, archive_dir=ANALYTICS_ARCHIVE_DIR,
+                    vacuum=False, now=None):
+    """Archives every live partition older than the retention horizon. Returns [(db file, month, archive file)]."""
+    cutoff = retention_cutoff(retention_months, now)
+    archived = []
+    for db_path in tenant_db_files():
+        conn = PooledConnection(get_pool(db_path))
+        try:
+            months = [r[0] for r in conn.execute(
+                "SELECT month FROM analytics_partitions WHERE archived_at IS NULL AND month < ? ORDER BY month",
+                (cutoff,))]
+        finally:
+            conn.close()
+        changed = False
+        for month in months:
+            target = archive_month(db_path, month, archive_dir)
+            archived.append((db_path, month, target))
+            changed = changed or target is not None
+        if vacuum and changed:
+            conn = PooledConnection(get_pool(db_path))
+            try:
+                conn.execute("VACUUM")
+            finally:
+                conn.close()
+    return archived
+
+
+# ----------------------------
+# Reading archives
+# ----------------------------
+def archive_files(archive_dir=ANALYTICS_ARCHIVE_DIR, start=None, end=None, db_path=None):
+    """
+    [(month, path)] of archive files whose month overlaps [start, end), oldest first;
+    only those written from db_path when it is given.
+    """
+    if not os.path.isdir(archive_dir):
+        return []
+    stem = _archive_stem(db_path) if db_path else None
+    files = []
+    for name in os.listdir(archive_dir):
+        match = _ARCHIVE_NAME.match(name)
+        if not match or (stem and match.group(1) != stem):
+            continue
+        month = match.group(2)
+        if (start and month < str(start)[:7]) or (end and month > str(end)[:7]):
+            continue
+        files.append((month, os.path.join(archive_dir, name)))
+    return sorted(files)
+
+
+def _client_rows(path, client_id):
+    # Files are sorted by (client_id, timestamp, id), so the client's rows come
+    # out in order and reading stops right after them
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            row = json.loads(line)
+            if row["client_id"] == client_id:
+                yield row
+            elif row["client_id"] > client_id:
+                return
+
+
+def _event_order(row):
+    return row["timestamp"] or "", row["id"]
+
+
+def iter_archived_events(client_id, start=None, end=None, event_type=None, archive_dir=ANALYTICS_ARCHIVE_DIR):
+    """Yields the client's archived events (ANALYTICS_EVENT_COLUMNS dicts) in (timestamp, id) order."""
+    client_id = int(client_id)
+    by_month = {}
+    # Only the archives of the database that holds this client's rows
+    for month, path in archive_files(archive_dir, start, end, db_path=tenant_db_file(client_id)):
+        by_month.setdefault(month, []).append(path)
+    for month in sorted(by_month):
+        # A month re-archived after late events has several files; each is
+        # already in order, so they are merged as they stream from gzip
+        rows = heapq.merge(*(_client_rows(path, client_id) for path in by_month[month]), key=_event_order)
+        for row in rows:
+            timestamp = row["timestamp"] or ""
+            if (start and timestamp < start) or (end and timestamp >= end):
+                continue
+            if event_type and row["event_type"] != event_type:
+                continue
+            yield {c: row.get(c) for c in ANALYTICS_EVENT_COLUMNS}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive old analytics partitions, or export archived events.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    archive = sub.add_parser("archive", help="archive months past the retention horizon")
+    archive.add_argument("--retention-months", type=int, default=ANALYTICS_RETENTION_MONTHS)
+    archive.add_argument("--archive-dir", default=ANALYTICS_ARCHIVE_DIR)
+    archive.add_argument("--vacuum", action="store_true", help="VACUUM databases that had partitions archived")
+    export = sub.add_parser("export", help="print a client's archived events as NDJSON")
+    export.add_argument("client_id", type=int)
+    export.add_argument("--since", help="ISO date or timestamp (inclusive)")
+    export.add_argument("--until", help="ISO date or timestamp (exclusive)")
+    export.add_argument("--event-type")
+    export.add_argument("--archive-dir", default=ANALYTICS_ARCHIVE_DIR)
+    args = parser.parse_args()
+
+    if args.command == "archive":
+        if args.retention_months < 1:
+            parser.error("--retention-months must be at least 1")
+        for db_path, month, target in archive_expired(args.retention_months, args.archive_dir, args.vacuum):
+            print(f"{db_path} {month}: {target or 'skipped, rows arrived during the dump; retry later'}",
+                  file=sys.stderr)
+    else:
+        for event in iter_archived_events(args.client_id, args.since, args.until, args.event_type, args.archive_dir):
+            print(json.dumps(event, ensure_ascii=False))
@@ -0,0 +1,261 @@
+# analytics_writer.py
+# Buffers analytics events in memory and writes them from a background thread
+# in batches, one executemany and one commit per tenant database, instead of
+# one connection, INSERT and fsync per event.
+import atexit
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from db import analytics_row, insert_analytics_rows, run_db, tenant_db_file
+
+# Flush after this many events, or this long after the oldest unwritten event arrived
+ANALYTICS_BATCH_SIZE = int(os.getenv("ANALYTICS_BATCH_SIZE", "200"))
+ANALYTICS_FLUSH_MS = float(os.getenv("ANALYTICS_FLUSH_MS", "200"))
+# Queue bound; when it is full, producers wait up to ANALYTICS_BACKPRESSURE_MS
+# for room and then write their event themselves
+ANALYTICS_QUEUE_MAX = int(os.getenv("ANALYTICS_QUEUE_MAX", "10000"))
+ANALYTICS_BACKPRESSURE_MS = float(os.getenv("ANALYTICS_BACKPRESSURE_MS", "50"))
+# A batch that hits a transient error (e.g. "database is locked") is retried this many
+# times, doubling the delay from ANALYTICS_RETRY_MS; then it is dropped and counted in busy_drops
+ANALYTICS_RETRIES = int(os.getenv("ANALYTICS_RETRIES", "3"))
+ANALYTICS_RETRY_MS = float(os.getenv("ANALYTICS_RETRY_MS", "50"))
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class AnalyticsWriter:
+    """
+    Group-commit writer for analytics rows. log() never touches the database
+    unless the queue stays full past the backpressure timeout, in which case
+    the event is written synchronously so nothing is dropped. A batch hitting a
+    locked/busy database is retried with backoff and dropped (counted in
+    "busy_drops") if it still fails; one failing for another reason is written
+    row by row, so only rows that fail on their own are lost (counted in "failed").
+    """
+
+    def __init__(self, batch_size=ANALYTICS_BATCH_SIZE, flush_ms=ANALYTICS_FLUSH_MS,
+                 max_queue=ANALYTICS_QUEUE_MAX, backpressure_ms=ANALYTICS_BACKPRESSURE_MS, write=insert_analytics_rows,
+                 retries=ANALYTICS_RETRIES, retry_ms=ANALYTICS_RETRY_MS):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_ms / 1000
+        self.max_queue = max_queue
+        self.backpressure = backpressure_ms / 1000
+        self.write = write
+        self.retries = max(0, retries)
+        self.retry_delay = retry_ms / 1000
+        self.listeners = []
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self.enqueued = 0
+        self.written = 0
+        self.batched = 0
+        self.failed = 0
+        self.retried = 0
+        self.busy_drops = 0
+        self.row_fallbacks = 0
+        self.flushes = 0
+        self.overflows = 0
+        self.max_depth = 0
+        self.total_flush = 0.0
+        self.max_flush = 0.0
+        self.last_flush = 0.0
+
+    # ----------------------------
+    # Producer side
+    # ----------------------------
+    def _started_queue(self):
+        # The thread does not survive fork(); a worker process starts its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue(maxsize=self.max_queue)
+                    self._thread = threading.Thread(target=self._run, name="analytics-writer", daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+        return self._queue
+
+    def _enqueued(self, q):
+        self.enqueued += 1
+        depth = q.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def log(self, client_id, event_type, details="", user_id=None, source="customer", data=None, timestamp=None):
+        """Queues one event; may block for up to the backpressure timeout."""
+        row = analytics_row(client_id, event_type, details, user_id, source, data, timestamp)
+        self._put(row, self.backpressure)
+
+    def _put(self, row, timeout):
+        q = self._started_queue()
+        try:
+            q.put(row, timeout=timeout)
+        except queue.Full:
+            self.overflows += 1
+            self.write([row])
+            self.written += 1
+            self._notify([row])
+            return
+        self._enqueued(q)
+
+    async def log_async(self, client_id, event_type, details="", user_id=None, source="customer", data=None, timestamp=None):
+        """Like log(), but waits for queue room (or writes on overflow) off the event loop."""
+        row = analytics_row(client_id, event_type, details, user_id, source, data, timestamp)
+        q = self._started_queue()
+        try:
+            q.put_nowait(row)
+        except queue.Full:
+            await run_db(self._put, row, self.backpressure)
+            return
+        self._enqueued(q)
+
+    # ----------------------------
+    # Writer thread
+    # ----------------------------
+    def _run(self):
+        q = self._queue
+        while True:
+            item = q.get()
+            batch, markers, stop = [], [], False
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is _STOP:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    markers.append(item)
+                else:
+                    batch.append(item)
+                # A flush()/shutdown() marker writes whatever is buffered right away
+                if stop or markers or len(batch) >= self.batch_size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = q.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if batch:
+                self._flush(batch)
+            for marker in markers:
+                marker.set()
+            if stop:
+                return
+
+    def _flush(self, batch):
+        started = time.perf_counter()
+        # One write per tenant database: each commits on its own, so a retry never repeats committed rows
+        groups = {}
+        for row in batch:
+            try:
+                path = tenant_db_file(row[0])
+            except Exception:
+                path = None  # a malformed client_id fails in its own group
+            groups.setdefault(path, []).append(row)
+        for rows in groups.values():
+            written = self._write_group(rows)
+            self.written += len(written)
+            self.batched += len(written)
+            if written:
+                self._notify(written)
+        elapsed = time.perf_counter() - started
+        self.flushes += 1
+        self.total_flush += elapsed
+        self.last_flush = elapsed
+        self.max_flush = max(self.max_flush, elapsed)
+
+    def _write_group(self, rows):
+        """Writes rows bound for one database; returns those committed."""
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                self.write(rows)
+                return rows
+            except sqlite3.OperationalError as e:
+                # Locked/busy database or disk trouble: worth another try
+                if attempt == self.retries:
+                    # Not a bad row: one by one, each write would wait out busy_timeout again
+                    self.failed += len(rows)
+                    self.busy_drops += len(rows)
+                    logger.error("Analytics write of %d events dropped after %d retries: %s",
+                                 len(rows), self.retries, e)
+                    return []
+                self.retried += 1
+                time.sleep(delay)
+                delay *= 2
+            except Exception as e:
+                # Most likely a bad row; retrying the whole batch would fail the same way
+                logger.warning("Analytics write of %d events failed (%s); writing them one by one", len(rows), e)
+                break
+
+        self.row_fallbacks += 1
+        written = []
+        for row in rows:
+            try:
+                self.write([row])
+                written.append(row)
+            except Exception as e:
+                self.failed += 1
+                logger.error("Analytics event dropped (client %s, %s): %s", row[0], row[3], e)
+        return written
+
+    def add_listener(self, fn):
+        """fn(rows) is called with every batch once it is committed, on the writer thread."""
+        self.listeners.append(fn)
+
+    def _notify(self, rows):
+        for fn in self.listeners:
+            try:
+                fn(rows)
+            except Exception as e:
+                logger.error("Analytics listener %r failed: %s", fn, e)
+
+    # ----------------------------
+    # Control
+    # ----------------------------
+    def flush(self, timeout=10):
+        """Blocks until everything queued before this call is written. Returns False on timeout."""
+        if self._pid != os.getpid():
+            return True
+        marker = threading.Event()
+        self._queue.put(marker)
+        return marker.wait(timeout)
+
+    def shutdown(self, timeout=10):
+        """Writes what is queued and stops the writer thread."""
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+            self._pid = None
+
+    def stats(self):
+        return {
+            "queue_depth": self._queue.qsize() if self._pid == os.getpid() else 0,
+            "max_queue_depth": self.max_depth,
+            "queue_limit": self.max_queue,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "failed": self.failed,
+            "retried": self.retried,
+            "busy_drops": self.busy_drops,
+            "row_fallbacks": self.row_fallbacks,
+            "overflows": self.overflows,
+            "flushes": self.flushes,
+            "avg_batch_size": round(self.batched / self.flushes, 2) if self.flushes else 0,
+            "last_flush_ms": round(self.last_flush * 1000, 3),
+            "avg_flush_ms": round(self.total_flush / self.flushes * 1000, 3) if self.flushes else 0,
+            "max_flush_ms": round(self.max_flush * 1000, 3),
+        }
+
+
+analytics_writer = AnalyticsWriter()
+# Scripts and tests exit without the FastAPI lifespan; don't lose their tail
+atexit.register(analytics_writer.shutdown)
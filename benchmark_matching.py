@@ -0,0 +1,300 @@
+# benchmark_matching.py
+# Replays synthetic tenants through the chatbot matching path (reply cache ->
+# FAQ matcher -> stub model) and reports throughput, latency percentiles,
+# FAQ hit rate and fallback rate as JSON. Messages go through main's own
+# _quick_reply / _ai_reply / _record_reply, with a stub model behind
+# ai_batcher and analytics logging switched off.
+#
+#   python benchmark_matching.py --output bench.json
+#   python benchmark_matching.py --baseline bench.json --max-regression 10
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+# faq_matcher imports db, which initializes DB_FILE on import; keep that away from real data
+os.environ.setdefault("DB_FILE", os.path.join(tempfile.gettempdir(), "asb_benchmark.db"))
+
+import rapidfuzz
+with contextlib.redirect_stdout(sys.stderr):  # keep db's init message out of the JSON on stdout
+    import main as app_main
+    import faq_matcher
+    from faq_matcher import FaqMatcher, FAQ_CANDIDATE_K
+    from db import get_faq_version
+    from inference import MicroBatcher
+    from reply_cache import ReplyCache
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+
+# ======================
+# SYNTHETIC TENANTS
+# ======================
+TEMPLATES = [
+    "How do I {verb} my {noun}?",
+    "How can I {verb} the {noun}?",
+    "Can I {verb} my {noun} {qualifier}?",
+    "Where do I {verb} my {noun}?",
+    "Is it possible to {verb} a {noun} {qualifier}?",
+    "What happens if I {verb} my {noun}?",
+    "Why can't I {verb} my {noun} {qualifier}?",
+    "When will you {verb} my {noun}?",
+]
+VERBS = ["reset", "change", "cancel", "update", "delete", "export", "download", "upgrade",
+         "downgrade", "transfer", "share", "renew", "verify", "recover", "track", "return",
+         "refund", "connect", "disconnect", "pause", "restore", "archive", "edit", "view"]
+NOUNS = ["password", "account", "subscription", "invoice", "order", "plan", "email address",
+         "payment method", "profile", "billing address", "shipping address", "team", "api key",
+         "integration", "widget", "chatbot", "data", "report", "license", "device", "workspace",
+         "phone number", "username", "avatar", "notification settings", "language", "domain",
+         "webhook", "calendar", "credit card", "gift card", "coupon", "package", "delivery",
+         "return label", "warranty", "support ticket", "trial", "contract", "seat"]
+QUALIFIERS = ["on mobile", "from the dashboard", "for my team", "without logging in", "after purchase",
+              "before renewal", "in the app", "on the website", "for another user", "this month"]
+SYNONYMS = {
+    "reset": "set again", "change": "modify", "cancel": "stop", "update": "refresh",
+    "delete": "remove", "download": "get", "track": "follow", "account": "profile",
+    "password": "passcode", "order": "purchase", "invoice": "bill", "plan": "tier",
+}
+FILLERS = ["please tell me", "hi,", "quick question:", "hello, i need help -", "i want to know"]
+UNKNOWN = ["what is the meaning of life", "tell me a joke", "who won the game yesterday",
+           "recommend a good book", "what's the weather like", "translate this to french"]
+
+
+def make_corpus(n, rng):
+    """n unique FAQ questions built from templates, verbs, nouns and qualifiers."""
+    questions = set()
+    while len(questions) < n:
+        template = rng.choice(TEMPLATES)
+        question = template.format(verb=rng.choice(VERBS), noun=rng.choice(NOUNS), qualifier=rng.choice(QUALIFIERS))
+        if len(questions) > len(TEMPLATES) * len(VERBS) * len(NOUNS) // 2:
+            # The template space is running out; suffix a ticket number to keep questions unique
+            question = f"{question[:-1]} (ref {rng.randint(1000, 99999)})?"
+        questions.add(question)
+    return sorted(questions)
+
+
+def add_typos(text, rng, count=1):
+    chars = list(text)
+    for _ in range(count):
+        if len(chars) < 2:
+            break
+        i = rng.randrange(len(chars) - 1)
+        op = rng.choice(("swap", "drop", "double", "replace"))
+        if op == "swap":
+            chars[i], chars[i + 1] = chars[i + 1], chars[i]
+        elif op == "drop":
+            del chars[i]
+        elif op == "double":
+            chars.insert(i, chars[i])
+        else:
+            chars[i] = rng.choice("abcdefghijklmnopqrstuvwxyz")
+    return "".join(chars)
+
+
+def paraphrase(text, rng):
+    words = text.rstrip("?").split()
+    words = [SYNONYMS.get(w.lower(), w) if rng.random() < 0.5 else w for w in words]
+    if len(words) > 4 and rng.random() < 0.5:
+        del words[rng.randrange(len(words))]
+    return f"{rng.choice(FILLERS)} {' '.join(words).lower()}"
+
+
+def make_stream(questions, n, typo_rate, paraphrase_rate, unknown_rate, repeat_rate, rng):
+    """Returns [(message, expected_question or None)]."""
+    stream = []
+    for _ in range(n):
+        if stream and rng.random() < repeat_rate:
+            stream.append(rng.choice(stream))
+            continue
+        if rng.random() < unknown_rate:
+            stream.append((rng.choice(UNKNOWN), None))
+            continue
+        question = rng.choice(questions)
+        message = question
+        if rng.random() < paraphrase_rate:
+            message = paraphrase(message, rng)
+        if rng.random() < typo_rate:
+            message = add_typos(message, rng, count=rng.randint(1, 3))
+        stream.append((message, question))
+    return stream
+
+
+class StubModel:
+    """Stands in for a DeepPavlov model: takes a batch, returns one answer per message."""
+
+    def __init__(self, latency_ms=0.0):
+        self.latency = latency_ms / 1000
+        self.calls = 0
+
+    def __call__(self, batch):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return ["I'm not sure, let me connect you with support."] * len(batch)
+
+
+class StubPool:
+    """The InferencePool interface ai_batcher needs, answered in-process by a StubModel."""
+
+    def __init__(self, model):
+        self.model = model
+
+    async def infer(self, client_id, batch):
+        return self.model(batch)
+
+
+async def _no_analytics(*args, **kwargs):
+    pass
+
+
+# ======================
+# REPLAY
+# ======================
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_tenant(client_id, n_faqs, args, rng):
+    questions = make_corpus(n_faqs, rng)
+    stream = make_stream(questions, args.messages, args.typo_rate, args.paraphrase_rate,
+                         args.unknown_rate, args.repeat_rate, rng)
+
+    build_start = time.perf_counter()
+    matcher = FaqMatcher(client_id, [{"question": q, "answer": f"Answer to: {q}"} for q in questions],
+                         candidate_k=args.candidate_k, db_version=get_faq_version(client_id))
+    build_seconds = time.perf_counter() - build_start
+
+    # main's request path, with this tenant's matcher registered and the model stubbed
+    model = StubModel(args.model_latency_ms)
+    faq_matcher._matchers[client_id] = matcher
+    app_main.ai_batcher = MicroBatcher(StubPool(model), window_ms=args.batch_window_ms)
+    app_main.reply_cache = ReplyCache(max_entries=args.reply_cache_size, ttl=3600)
+    app_main.log_analytics_event_async = _no_analytics
+
+    latencies = []
+    faq_hits = correct = cache_hits = fallbacks = 0
+
+    async def replay():
+        nonlocal faq_hits, correct, cache_hits, fallbacks
+        for message, expected in stream:
+            t0 = time.perf_counter()
+            cache_version, reply = await app_main._quick_reply(client_id, message)
+            if reply:
+                bot_reply, source, matched, cached = reply
+            else:
+                bot_reply, source = await app_main._ai_reply(client_id, message)
+                matched, cached = None, False
+            await app_main._record_reply(client_id, None, message, cache_version, bot_reply, source, matched, cached)
+            latencies.append(time.perf_counter() - t0)
+
+            cache_hits += cached
+            if matched:
+                faq_hits += 1
+                correct += matched == expected
+            else:
+                fallbacks += 1
+
+    started = time.perf_counter()
+    asyncio.run(replay())
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    total = len(stream)
+    answerable = sum(1 for _, expected in stream if expected)
+    return {
+        "faqs": n_faqs,
+        "messages": total,
+        "build_seconds": round(build_seconds, 4),
+        "throughput_msgs_per_s": round(total / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        },
+        "faq_hit_rate": round(faq_hits / total, 4),
+        "fallback_rate": round(fallbacks / total, 4),
+        "cache_hit_rate": round(cache_hits / total, 4),
+        # Of the messages generated from an FAQ, how many matched that exact FAQ
+        "correct_match_rate": round(correct / answerable, 4) if answerable else None,
+        "model_calls": model.calls,
+    }
+
+
+def compare(results, baseline, max_regression):
+    """Returns human-readable regressions against a previous run's JSON."""
+    previous = {r["faqs"]: r for r in baseline.get("results", [])}
+    regressions = []
+    for r in results:
+        old = previous.get(r["faqs"])
+        if not old:
+            continue
+        if old["throughput_msgs_per_s"] and r["throughput_msgs_per_s"] < old["throughput_msgs_per_s"] * (1 - max_regression / 100):
+            regressions.append(f"{r['faqs']} FAQs: throughput {old['throughput_msgs_per_s']} -> {r['throughput_msgs_per_s']} msg/s")
+        if old["latency_ms"]["p95"] and r["latency_ms"]["p95"] > old["latency_ms"]["p95"] * (1 + max_regression / 100):
+            regressions.append(f"{r['faqs']} FAQs: p95 {old['latency_ms']['p95']} -> {r['latency_ms']['p95']} ms")
+        if old["faq_hit_rate"] - r["faq_hit_rate"] > 0.01:
+            regressions.append(f"{r['faqs']} FAQs: FAQ hit rate {old['faq_hit_rate']} -> {r['faq_hit_rate']}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the chatbot FAQ matching path.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="FAQ corpus sizes")
+    parser.add_argument("--messages", type=int, default=2000, help="messages replayed per tenant")
+    parser.add_argument("--typo-rate", type=float, default=0.3)
+    parser.add_argument("--paraphrase-rate", type=float, default=0.3)
+    parser.add_argument("--unknown-rate", type=float, default=0.15, help="share of messages no FAQ answers")
+    parser.add_argument("--repeat-rate", type=float, default=0.0, help="share of messages repeating an earlier one")
+    parser.add_argument("--candidate-k", type=int, default=FAQ_CANDIDATE_K, help="0 = brute force")
+    parser.add_argument("--reply-cache-size", type=int, default=0, help="0 disables the reply cache")
+    parser.add_argument("--model-latency-ms", type=float, default=0.0, help="simulated stub model latency")
+    parser.add_argument("--batch-window-ms", type=float, default=0.0,
+                        help="ai_batcher window; messages are replayed one at a time, so 0 by default")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    parser.add_argument("--baseline", help="previous JSON output to compare against")
+    parser.add_argument("--max-regression", type=float, default=10.0, help="allowed slowdown in percent")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    # One synthetic client id per corpus size, so tenants never share a matcher or cache entries
+    results = [run_tenant(-1 - i, n, args, rng) for i, n in enumerate(args.sizes)]
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "rapidfuzz": rapidfuzz.__version__,
+            "params": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+        },
+        "results": results,
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        report["regressions"] = regressions
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    for line in regressions:
+        print(f"REGRESSION: {line}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+# chatbot_batch.py
+# Batch chatbot replies for offline replay and bulk evaluation. Does not log
+# analytics or use the reply cache, so replays never skew dashboards. Model
+# replies served over /chatbot_batch count against the monthly AI quota; the
+# command line replay below is an operator tool and is not metered.
+#
+#   python chatbot_batch.py CLIENT_ID messages.txt > replies.jsonl
+import argparse
+import asyncio
+import json
+import sys
+from faq_matcher import get_matcher, get_matcher_async
+from inference import AI_BATCH_MAX_SIZE
+from quota import ai_quota, QUOTA_EXCEEDED_REPLY
+
+# Upper bound on messages per /chatbot_batch request
+CHATBOT_BATCH_MAX_MESSAGES = 5000
+
+# Reply to blank messages (shared with main.py); they never reach matching or the model
+EMPTY_MESSAGE_REPLY = "Please type a message."
+
+
+def match_batch(client_id, messages, matcher=None):
+    """
+    Returns one result dict per message: reply, source, matched_question and score.
+    FAQ misses have source None; reply_batch fills them in from the model.
+    Blank messages get EMPTY_MESSAGE_REPLY with source "empty".
+    """
+    matcher = matcher or get_matcher(client_id)
+    texts = [m for m in messages if m.strip()]
+    matches = iter(matcher.match_many(texts))
+    results = []
+    for message in messages:
+        if not message.strip():
+            results.append({"message": message, "reply": EMPTY_MESSAGE_REPLY, "source": "empty",
+                            "matched_question": None, "score": None})
+            continue
+        match = next(matches)
+        if match:
+            question, answer, score = match
+            results.append({"message": message, "reply": answer, "source": "faq",
+                            "matched_question": question, "score": score})
+        else:
+            results.append({"message": message, "reply": None, "source": None,
+                            "matched_question": None, "score": None})
+    return results
+
+
+def _misses(results):
+    return [i for i, r in enumerate(results) if r["source"] is None]
+
+
+def _fill(results, indexes, replies=None, error=None, source="ai"):
+    for i, reply in zip(indexes, replies or [None] * len(indexes)):
+        if error is not None:
+            results[i].update(reply=f"Error processing message: {error}", source="error")
+        else:
+            results[i].update(reply=reply, source=source)
+
+
+def reply_batch(client_id, messages, matcher=None, model=None, batch_size=AI_BATCH_MAX_SIZE):
+    """
+    Synchronous entry point: FAQ matching for every message, then the model
+    (load_client_model by default, or any callable taking a list) for the misses.
+    """
+    results = match_batch(client_id, messages, matcher)
+    misses = _misses(results)
+    if misses and model is None:
+        from models_utils import load_client_model
+        try:
+            model = load_client_model(client_id)
+        except Exception as e:
+            _fill(results, misses, error=e)
+            return results
+
+    for start in range(0, len(misses), batch_size):
+        chunk = misses[start:start + batch_size]
+        try:
+            _fill(results, chunk, list(model([messages[i] for i in chunk])))
+        except Exception as e:
+            _fill(results, chunk, error=e)
+    return results
+
+
+async def reply_batch_async(client_id, messages, matcher=None, batch_size=AI_BATCH_MAX_SIZE, plan=None):
+    """
+    Same as reply_batch, but runs the misses through the inference pool without blocking the loop.
+    With a plan, the misses are counted against its monthly AI quota first; those the
+    allowance does not cover get QUOTA_EXCEEDED_REPLY, and failed chunks are refunded.
+    """
+    from inference import inference_pool
+
+    matcher = matcher or await get_matcher_async(client_id)
+    # Scoring thousands of messages is CPU-bound: keep it off the event loop, and off the DB executor
+    results = await asyncio.to_thread(match_batch, client_id, messages, matcher)
+    misses = _misses(results)
+    if plan is not None and misses:
+        granted = await ai_quota.acquire_many_async(client_id, plan, len(misses))
+        _fill(results, misses[granted:], [QUOTA_EXCEEDED_REPLY] * (len(misses) - granted), source="quota")
+        misses = misses[:granted]
+    for start in range(0, len(misses), batch_size):
+        chunk = misses[start:start + batch_size]
+        try:
+            _fill(results, chunk, await inference_pool.infer(client_id, [messages[i] for i in chunk]))
+        except Exception as e:
+            if plan is not None:
+                ai_quota.release(client_id, len(chunk))
+            _fill(results, chunk, error=e)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay messages against a client's FAQs and model.")
+    parser.add_argument("client_id", type=int)
+    parser.add_argument("messages", help="text file with one message per line ('-' for stdin)")
+    parser.add_argument("--faq-only", action="store_true", help="skip the model for FAQ misses")
+    args = parser.parse_args()
+
+    source = sys.stdin if args.messages == "-" else open(args.messages, encoding="utf-8")
+    with source:
+        msgs = [line.strip() for line in source if line.strip()]
+
+    if args.faq_only:
+        out = match_batch(args.client_id, msgs)
+    else:
+        out = reply_batch(args.client_id, msgs)
+    for row in out:
+        print(json.dumps(row, ensure_ascii=False))
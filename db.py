@@ -1,5 +1,15 @@
 import sqlite3
 import os
+import asyncio
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial
+from hll import HyperLogLog
 
 # Centralized DB file (matches main.py and analytics.py)
 DB_FILE = os.getenv("DB_FILE", r"D:\ai-support-bot\ai-support-bot.db")
@@ -20,7 +30,9 @@ def add_client(email, name=None, picture=None):
             
             # Import here to avoid circular import
             from models_utils import create_client_model
-            create_client_model(client_id)
+            create_client_model(client_id, conn=conn)
+            from identity import invalidate_identity
+            invalidate_identity(email)
         except sqlite3.IntegrityError:
             pass
 
@@ -28,46 +40,508 @@ def add_client(email, name=None, picture=None):
 
 
 def save_welcome_message_to_db(client_id, message):
-    conn = sqlite3.connect("db.sqlite")  # make sure this matches your DB file
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE clients SET welcome_message = ? WHERE id = ?",
-        (message, client_id)
-    )
-    conn.commit()
-    conn.close()
+    with get_tenant_db(client_id) as conn:
+        conn.execute("""
+            INSERT INTO welcome_messages (client_id, message) VALUES (?, ?)
+            ON CONFLICT(client_id) DO UPDATE SET message=excluded.message
+        """, (client_id, message))
 
 # ======================
 # DATABASE CONNECTIONS
 # ======================
+# Connection pool sizing and the PRAGMAs applied once per pooled connection
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # seconds to wait for a free connection
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "30000"))
+# How often a background thread runs PRAGMA optimize on each pool, so planner stats follow the data
+DB_OPTIMIZE_SECONDS = float(os.getenv("DB_OPTIMIZE_SECONDS", "3600"))
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of SQLite connections to one database file.
+    Connections are configured once when created (WAL, synchronous=NORMAL,
+    cache/mmap size, busy timeout, foreign keys) and reused afterwards.
+    optimize() (every DB_OPTIMIZE_SECONDS, from a background thread) and close()
+    run PRAGMA optimize, which re-analyzes the tables whose statistics the
+    connections' queries found missing or stale.
+    """
+
+    def __init__(self, db_file, max_size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.db_file = db_file
+        self.pid = os.getpid()
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()  # most recently used first, so its page cache is warm
+        self._lock = threading.Lock()
+        self._created = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.acquisitions = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.optimizes = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                               detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA foreign_keys = ON;")
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB};")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE};")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS};")
+        # Caps the rows each ANALYZE run by PRAGMA optimize looks at per index
+        conn.execute("PRAGMA analysis_limit=1000;")
+        return conn
+
+    def acquire(self):
+        started = time.perf_counter()
+        conn = None
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.max_size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self.timeouts += 1
+                    raise sqlite3.OperationalError(
+                        f"No database connection available after {self.timeout}s (pool size {self.max_size})")
+                with self._lock:
+                    self.waits += 1
+
+        waited = time.perf_counter() - started
+        with self._lock:
+            self.acquisitions += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+        return conn
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.row_factory = sqlite3.Row
+        except sqlite3.Error:
+            # Broken connection: drop it and let the pool create a new one
+            conn.close()
+            with self._lock:
+                self._created -= 1
+                self.in_use -= 1
+            return
+        with self._lock:
+            self.in_use -= 1
+        self._idle.put(conn)
+
+    def optimize(self):
+        """Runs PRAGMA optimize on the most recently used idle connection (its queries decide what is analyzed)."""
+        conn = self.acquire()
+        try:
+            self._optimize(conn)
+        finally:
+            self.release(conn)
+
+    def _optimize(self, conn):
+        try:
+            conn.execute("PRAGMA optimize;")
+            self.optimizes += 1
+        except sqlite3.Error:
+            # e.g. another writer held the lock past busy_timeout; the next run retries
+            pass
+
+    def close(self):
+        """Optimizes and closes the idle connections, e.g. at shutdown."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._optimize(conn)
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    @contextmanager
+    def connection(self):
+        """Yields a pooled connection; commits on success, rolls back on error."""
+        conn = self.acquire()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self.release(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "db_file": self.db_file,
+                "size": self._created,
+                "max_size": self.max_size,
+                "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use,
+                "utilization": round(self.in_use / self.max_size, 3) if self.max_size else 0,
+                "acquisitions": self.acquisitions,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "avg_wait_ms": round(self.total_wait / self.acquisitions * 1000, 3) if self.acquisitions else 0,
+                "max_wait_ms": round(self.max_wait * 1000, 3),
+                "optimizes": self.optimizes,
+            }
+
+
+class PooledConnection:
+    """
+    sqlite3.Connection stand-in handed out by get_db()/get_db_connection().
+    close() returns the connection to its pool; 'with conn:' commits (or rolls
+    back) like sqlite3 does and then returns it too.
+    """
+
+    def __init__(self, pool):
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_conn", pool.acquire())
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get("_conn")
+        if conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def close(self):
+        conn = self.__dict__.get("_conn")
+        if conn is not None:
+            object.__setattr__(self, "_conn", None)
+            self._pool.release(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        conn = self.__dict__.get("_conn")
+        if conn is not None:
+            if exc_type is None:
+                conn.commit()
+            else:
+                conn.rollback()
+        self.close()
+        return False
+
+    def __del__(self):
+        # Safety net for callers that never close: don't leak the pool slot
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+_pools = {}  # {db_file: ConnectionPool}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_file=None):
+    db_file = db_file or DB_FILE
+    pool = _pools.get(db_file)
+    # SQLite connections must not cross fork(); worker processes get their own pools
+    if pool is None or pool.pid != os.getpid():
+        with _pools_lock:
+            pool = _pools.get(db_file)
+            if pool is None or pool.pid != os.getpid():
+                pool = _pools[db_file] = ConnectionPool(db_file)
+                _start_optimizer()
+    return pool
+
+
+def pool_stats():
+    return [pool.stats() for pool in list(_pools.values())]
+
+
+_optimizer_pid = None
+_optimizer_lock = threading.Lock()
+
+
+def _start_optimizer():
+    # Off the request path: ANALYZE may wait on other writers for up to busy_timeout.
+    # The thread does not survive fork(); a worker process starts its own.
+    global _optimizer_pid
+    if DB_OPTIMIZE_SECONDS <= 0 or _optimizer_pid == os.getpid():
+        return
+    with _optimizer_lock:
+        if _optimizer_pid != os.getpid():
+            threading.Thread(target=_run_optimizer, name="db-optimize", daemon=True).start()
+            _optimizer_pid = os.getpid()
+
+
+def _run_optimizer():
+    while True:
+        time.sleep(DB_OPTIMIZE_SECONDS)
+        for pool in list(_pools.values()):
+            if pool.pid == os.getpid():
+                try:
+                    pool.optimize()
+                except sqlite3.Error:
+                    pass  # pool exhausted past its timeout; try again next round
+
+
+def close_pools():
+    """Closes this process's idle pooled connections, running PRAGMA optimize on each first."""
+    for pool in list(_pools.values()):
+        if pool.pid == os.getpid():
+            pool.close()
+
+
+@contextmanager
+def db_connection():
+    """Context manager over a pooled connection: commits on success, rolls back on error."""
+    with get_pool().connection() as conn:
+        yield conn
+
+
+def get_pooled_db():
+    """FastAPI dependency: a pooled connection for the duration of the request."""
+    with get_pool().connection() as conn:
+        yield conn
+
+
 def get_db():
     """
-    Returns a SQLite connection with row_factory as Row and foreign key support enabled.
-    Use with 'with get_db() as conn:' or manually close after use.
+    Returns a pooled SQLite connection with row_factory as Row and foreign key support enabled.
+    Use with 'with get_db() as conn:' (commits and returns it to the pool) or close() after use.
     """
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON;")
-    return conn
+    return PooledConnection(get_pool())
 
 
 def get_db_connection():
-    conn = sqlite3.connect(DB_FILE, timeout=30, detect_types=sqlite3.PARSE_DECLTYPES)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON;")
-    conn.execute("PRAGMA journal_mode=WAL;")  # optional but helps concurrency
-    return conn
+    return PooledConnection(get_pool())
+
+
+# ======================
+# TENANT SHARDS
+# ======================
+# With DB_SHARDS > 0, tenant-scoped tables live in DB_SHARDS bucket files
+# (client_id % DB_SHARDS) under DB_SHARD_DIR, so a busy tenant's writes only
+# hold its own bucket's write lock. Global tables (clients, subscriptions,
+# client_models, ...) stay in DB_FILE, the catalog. DB_SHARDS=0 keeps
+# everything in DB_FILE. Changing DB_SHARDS needs split_shards.py.
+DB_SHARDS = int(os.getenv("DB_SHARDS", "0"))
+DB_SHARD_DIR = os.getenv("DB_SHARD_DIR") or os.path.join(os.path.dirname(os.path.abspath(DB_FILE)), "shards")
+TENANT_TABLES = ("faqs", "analytics", "chat_logs", "audit_logs", "welcome_messages", "bot_settings")
+
+_ready_shards = set()  # shard files whose schema is current
+_ready_shards_lock = threading.Lock()
+
+
+def shard_index(client_id):
+    return int(client_id) % DB_SHARDS
+
+
+def shard_file(index):
+    return os.path.join(DB_SHARD_DIR, f"shard_{index:03d}.db")
+
 
+def tenant_db_file(client_id):
+    """The database file holding this client's tenant-scoped rows (the catalog for client_id None)."""
+    if DB_SHARDS <= 0 or client_id is None:
+        return DB_FILE
+    path = shard_file(shard_index(client_id))
+    if path not in _ready_shards:
+        _prepare_shard(path)
+    return path
+
+
+def _prepare_shard(path):
+    with _ready_shards_lock:
+        if path in _ready_shards:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = PooledConnection(get_pool(path))
+        try:
+            migrate(conn, SHARD_MIGRATIONS)
+        finally:
+            conn.close()
+        _ready_shards.add(path)
+
+
+def get_tenant_db(client_id):
+    """Like get_db(), but connected to the database that holds this client's tenant-scoped tables."""
+    return PooledConnection(get_pool(tenant_db_file(client_id)))
+
+
+def tenant_conn(client_id, conn):
+    """
+    conn, if it is a catalog connection that also holds this client's tenant tables,
+    else None. Lets code that already holds a pooled connection reuse it instead
+    of waiting on the same pool for a second one.
+    """
+    return conn if conn is not None and tenant_db_file(client_id) == DB_FILE else None
+
+
+def tenant_db_files():
+    """Every database file that holds tenant-scoped rows."""
+    if DB_SHARDS <= 0:
+        return [DB_FILE]
+    # Client id i lands in bucket i, so this prepares every shard
+    return [tenant_db_file(i) for i in range(DB_SHARDS)]
+
+
+def fan_out(sql, params=()):
+    """Runs a read query against every tenant database and returns all rows, for cross-tenant reads."""
+    rows = []
+    for path in tenant_db_files():
+        conn = PooledConnection(get_pool(path))
+        try:
+            rows.extend(conn.execute(sql, params).fetchall())
+        finally:
+            conn.close()
+    return rows
+
+
+
+# Event type the monthly AI allowance was counted from before quota.py kept
+# its own counters; only used to seed ai_usage_monthly
+AI_USAGE_EVENT = "ai_request"
 
 
 # ======================
-# INITIALIZE TABLES
+# ANALYTICS PARTITIONS
 # ======================
-def init_all_db():
+# Raw analytics rows live in one table per month (analytics_YYYY_MM) in each
+# tenant database, listed in analytics_partitions. 'analytics' is a view over
+# the live partitions for ad-hoc and full-history reads; request-path reads go
+# through analytics_partitions() and only touch the months they need.
+# analytics_archive.py moves months past the retention horizon to gzip-JSONL.
+ANALYTICS_COLUMNS = ("id", "client_id", "user_id", "event_type", "details", "timestamp", "source", "data")
+# Rows whose timestamp has no 'YYYY-MM' prefix
+ANALYTICS_UNDATED_MONTH = "0000-00"
+
+_known_partitions = {}  # {db file: {month}} partitions this process has seen created
+
+
+def analytics_partition_month(timestamp):
+    month = str(timestamp or "")[:7]
+    if len(month) == 7 and month[4] == "-" and month[:4].isdigit() and month[5:].isdigit():
+        return month
+    return ANALYTICS_UNDATED_MONTH
+
+
+def analytics_partition_table(month):
+    return "analytics_" + month.replace("-", "_")
+
+
+def _refresh_analytics_view(conn):
+    tables = [r[0] for r in conn.execute(
+        "SELECT table_name FROM analytics_partitions WHERE archived_at IS NULL ORDER BY month")]
+    columns = ", ".join(ANALYTICS_COLUMNS)
+    body = " UNION ALL ".join(f"SELECT {columns} FROM {table}" for table in tables)
+    if not body:
+        body = "SELECT " + ", ".join(f"NULL AS {c}" for c in ANALYTICS_COLUMNS) + " WHERE 0"
+    conn.execute("DROP VIEW IF EXISTS analytics")
+    conn.execute(f"CREATE VIEW analytics AS {body}")
+
+
+def ensure_analytics_partition(conn, month):
+    """Creates the month's partition if needed (inside the caller's transaction). Returns its table name."""
+    table = analytics_partition_table(month)
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY,
+            client_id INTEGER NOT NULL,
+            user_id TEXT,
+            event_type TEXT,
+            details TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            source TEXT DEFAULT 'customer',
+            data TEXT
+        )
+    """)
+    # Same access paths the single table had, now bounded to one month
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_client_ts ON {table}(client_id, timestamp)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_client_event_ts ON {table}(client_id, event_type, timestamp)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_event_ts ON {table}(event_type, timestamp)")
+    # A late event for an archived month brings its partition back; archive_path
+    # is kept so the next archive run writes a second file instead of replacing it
+    conn.execute("""
+        INSERT INTO analytics_partitions (month, table_name) VALUES (?, ?)
+        ON CONFLICT(month) DO UPDATE SET archived_at = NULL
+    """, (month, table))
+    _refresh_analytics_view(conn)
+    return table
+
+
+def drop_analytics_partition(conn, path, month, archive_path=None):
+    """Drops a month's partition from the database at path (inside the caller's transaction)."""
+    conn.execute(f"DROP TABLE IF EXISTS {analytics_partition_table(month)}")
+    conn.execute("UPDATE analytics_partitions SET archived_at = ?, archive_path = COALESCE(?, archive_path) "
+                 "WHERE month = ?", (datetime.utcnow().isoformat(), archive_path, month))
+    _refresh_analytics_view(conn)
+    _known_partitions.get(path, set()).discard(month)
+
+
+def analytics_partition_tables(conn, start=None, end=None):
     """
-    Initialize all tables if they do not exist.
+    Live partition tables whose month overlaps [start, end) (ISO dates or
+    timestamps, either may be None), oldest first.
     """
-    conn = get_db_connection()
+    sql = "SELECT month, table_name FROM analytics_partitions WHERE archived_at IS NULL"
+    params = []
+    if start:
+        sql += " AND month >= ?"
+        params.append(str(start)[:7])
+    if end:
+        sql += " AND month <= ?"
+        params.append(str(end)[:7])
+    return [r["table_name"] for r in conn.execute(sql + " ORDER BY month", params)]
+
+
+def fan_out_analytics(sql, params=(), start=None, end=None):
+    """
+    fan_out() for raw analytics: runs sql, which names its table '{table}',
+    against every live partition in range in every tenant database.
+    """
+    rows = []
+    for path in tenant_db_files():
+        conn = PooledConnection(get_pool(path))
+        try:
+            for table in analytics_partition_tables(conn, start, end):
+                rows.extend(conn.execute(sql.format(table=table), params).fetchall())
+        finally:
+            conn.close()
+    return rows
+
+
+# ======================
+# SCHEMA MIGRATIONS
+# ======================
+# PRAGMA user_version records the last migration applied. Startup only reads
+# it, and runs pending migrations in order, each in its own transaction.
+# Append new migrations to MIGRATIONS; never edit one that has shipped.
+
+def _migration_baseline(conn):
+    """Tables as they existed before versioning; IF NOT EXISTS adopts older databases."""
 
     # Clients
     conn.execute("""
@@ -200,9 +674,341 @@ def init_all_db():
         );
     """)
 
-    conn.commit()
-    conn.close()
-    print("✅ All tables initialized successfully.")
+
+def _migration_analytics_columns(conn):
+    """analytics.source and analytics.data, written by the event loggers but missing from the baseline."""
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(analytics)")}
+    if "source" not in columns:
+        conn.execute("ALTER TABLE analytics ADD COLUMN source TEXT DEFAULT 'customer'")
+    if "data" not in columns:
+        conn.execute("ALTER TABLE analytics ADD COLUMN data TEXT")
+
+
+def _migration_hot_path_indexes(conn):
+    """Indexes for the lookups on the request path."""
+    # Login/session checks compare lower(email); the UNIQUE(email) index cannot serve that
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_clients_email_lower ON clients(lower(email))")
+    # Per-client analytics by event type and time range (AI usage, rollups)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_analytics_client_event_ts ON analytics(client_id, event_type, timestamp)")
+    # Per-client time range across all event types (active users, daily chart)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_analytics_client_ts ON analytics(client_id, timestamp)")
+    # Cross-client scans by event type and time (model prewarm ranking)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_analytics_event_ts ON analytics(event_type, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bot_settings_client_name ON bot_settings(client_id, setting_name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_client_integrations_client ON client_integrations(client_id)")
+
+
+def _create_analytics_rollups(conn):
+    """
+    Rollups maintained at ingest time by insert_analytics_rows(), so the
+    dashboard summary never scans raw analytics.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS analytics_totals (
+            client_id INTEGER PRIMARY KEY,
+            events INTEGER NOT NULL DEFAULT 0
+        );
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS analytics_daily (
+            client_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            event_type TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (client_id, day, event_type)
+        ) WITHOUT ROWID;
+    """)
+    # One row per user per active day, for "active users in the last N days"
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS analytics_daily_users (
+            client_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            PRIMARY KEY (client_id, day, user_id)
+        ) WITHOUT ROWID;
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ai_usage_monthly (
+            client_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            requests INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (client_id, month)
+        ) WITHOUT ROWID;
+    """)
+
+
+def rebuild_analytics_rollups(conn):
+    """
+    Recomputes the rollups from raw analytics (backfill, or after copying rows
+    between files). Months that were ever archived keep their rollup rows,
+    since their raw rows are no longer in the database.
+    """
+    scope = ""
+    if _has_table(conn, "analytics_partitions"):
+        scope = """AND substr({day}, 1, 7) IN (
+            SELECT month FROM analytics_partitions WHERE archived_at IS NULL AND archive_path IS NULL)"""
+    for table in ("analytics_daily", "analytics_daily_users"):
+        conn.execute(f"DELETE FROM {table} WHERE 1 {scope.format(day='day')}")
+    conn.execute(f"""
+        INSERT INTO analytics_daily (client_id, day, event_type, count)
+        SELECT CAST(client_id AS INTEGER), substr(timestamp, 1, 10), COALESCE(event_type, ''), COUNT(*)
+        FROM analytics WHERE timestamp IS NOT NULL {scope.format(day='timestamp')}
+        GROUP BY 1, 2, 3
+    """)
+    conn.execute(f"""
+        INSERT OR IGNORE INTO analytics_daily_users (client_id, day, user_id)
+        SELECT DISTINCT CAST(client_id AS INTEGER), substr(timestamp, 1, 10), user_id
+        FROM analytics WHERE timestamp IS NOT NULL AND user_id IS NOT NULL {scope.format(day='timestamp')}
+    """)
+    conn.execute("DELETE FROM analytics_totals")
+    conn.execute("""
+        INSERT INTO analytics_totals (client_id, events)
+        SELECT client_id, SUM(count) FROM analytics_daily GROUP BY client_id
+    """)
+    if _has_table(conn, "analytics_daily_sketches"):
+        rebuild_daily_sketches(conn)
+
+
+def _has_table(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name=?", (name,)).fetchone() is not None
+
+
+def rebuild_daily_sketches(conn):
+    """Recomputes every daily user sketch from the exact analytics_daily_users sets."""
+    conn.execute("DELETE FROM analytics_daily_sketches")
+    sketches = {}
+    for row in conn.execute("SELECT client_id, day, user_id FROM analytics_daily_users"):
+        sketches.setdefault((row[0], row[1]), HyperLogLog()).add(row[2])
+    conn.executemany("INSERT INTO analytics_daily_sketches (client_id, day, sketch) VALUES (?, ?, ?)",
+                     [(*key, sketch.to_bytes()) for key, sketch in sketches.items()])
+
+
+def _seed_ai_usage(conn):
+    # One-time backfill; from then on ai_usage_monthly is owned by quota.py
+    conn.execute(f"""
+        INSERT OR IGNORE INTO ai_usage_monthly (client_id, month, requests)
+        SELECT CAST(client_id AS INTEGER), substr(timestamp, 1, 7), COUNT(*)
+        FROM analytics WHERE timestamp IS NOT NULL AND event_type = '{AI_USAGE_EVENT}'
+        GROUP BY 1, 2
+    """)
+
+
+def _migration_analytics_rollups(conn):
+    _create_analytics_rollups(conn)
+    rebuild_analytics_rollups(conn)
+    _seed_ai_usage(conn)
+
+
+def _migration_plan_entitlements(conn):
+    # Single source of plan limits; NULL monthly_ai_requests means unlimited
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS plan_entitlements (
+            plan TEXT PRIMARY KEY,
+            max_faqs INTEGER NOT NULL,
+            monthly_ai_requests INTEGER
+        ) WITHOUT ROWID
+    """)
+    conn.executemany("INSERT OR IGNORE INTO plan_entitlements VALUES (?, ?, ?)", [
+        ("demo", 5, 100),
+        ("onetime", 20, 500),
+        ("basic", 50, 1000),
+        ("standard", 100, 5000),
+        ("premium", 200, None),
+    ])
+
+
+def _migration_analytics_partitions(conn):
+    """Splits the analytics table into monthly partitions and replaces it with a view."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS analytics_partitions (
+            month TEXT PRIMARY KEY,
+            table_name TEXT NOT NULL,
+            archived_at TEXT,
+            archive_path TEXT
+        ) WITHOUT ROWID
+    """)
+    # Partitions share one id sequence, so ids stay unique across months
+    conn.execute("CREATE TABLE IF NOT EXISTS analytics_ids (last_id INTEGER NOT NULL)")
+    conn.execute("ALTER TABLE analytics RENAME TO analytics_unpartitioned")
+    last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM analytics_unpartitioned").fetchone()[0]
+    conn.execute("INSERT INTO analytics_ids (last_id) VALUES (?)", (last_id,))
+
+    columns = ", ".join(ANALYTICS_COLUMNS)
+    month_of = ("CASE WHEN substr(timestamp, 1, 7) GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]' "
+                f"THEN substr(timestamp, 1, 7) ELSE '{ANALYTICS_UNDATED_MONTH}' END")
+    months = [r[0] for r in conn.execute(f"SELECT DISTINCT {month_of} FROM analytics_unpartitioned")]
+    for month in months:
+        table = ensure_analytics_partition(conn, month)
+        conn.execute(f"""
+            INSERT INTO {table} ({columns})
+            SELECT {columns} FROM analytics_unpartitioned WHERE {month_of} = ?
+        """, (month,))
+    conn.execute("DROP TABLE analytics_unpartitioned")
+    _refresh_analytics_view(conn)
+
+
+def _migration_daily_sketches(conn):
+    """Per client and day HyperLogLog of active users; the dashboard merges these instead of counting sets."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS analytics_daily_sketches (
+            client_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            sketch BLOB NOT NULL,
+            PRIMARY KEY (client_id, day)
+        ) WITHOUT ROWID
+    """)
+    rebuild_daily_sketches(conn)
+
+
+def _migration_faq_versions(conn):
+    """
+    Per client counter bumped by triggers on every FAQ write, so each worker's
+    in-memory matcher can tell with one primary-key read that another worker changed the FAQs.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS faq_versions (
+            client_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+    """)
+    conn.execute("INSERT OR IGNORE INTO faq_versions (client_id, version) SELECT DISTINCT client_id, 1 FROM faqs")
+    for event, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_faqs_version_{event.lower()} AFTER {event} ON faqs
+            BEGIN
+                INSERT INTO faq_versions (client_id, version) VALUES ({row}.client_id, 1)
+                ON CONFLICT(client_id) DO UPDATE SET version = version + 1;
+            END
+        """)
+
+
+MIGRATIONS = [
+    (1, _migration_baseline),
+    (2, _migration_analytics_columns),
+    (3, _migration_hot_path_indexes),
+    (4, _migration_analytics_rollups),
+    (5, _migration_plan_entitlements),
+    (6, _migration_analytics_partitions),
+    (7, _migration_daily_sketches),
+    (8, _migration_faq_versions),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _shard_baseline(conn):
+    """Tenant-scoped tables for a shard file. No foreign keys: clients lives in the catalog."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS faqs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_id INTEGER NOT NULL,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            popular BOOLEAN NOT NULL DEFAULT 0,
+            UNIQUE(client_id, question)
+        );
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS welcome_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_id INTEGER NOT NULL UNIQUE,
+            message TEXT
+        );
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS chat_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_id INTEGER NOT NULL,
+            sender TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS bot_settings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_id INTEGER NOT NULL,
+            setting_name TEXT NOT NULL,
+            setting_value TEXT
+        );
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS audit_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_id INTEGER,
+            action TEXT NOT NULL,
+            performed_by TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS analytics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_id INTEGER NOT NULL,
+            user_id TEXT,
+            event_type TEXT,
+            details TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            source TEXT DEFAULT 'customer',
+            data TEXT
+        );
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_analytics_client_event_ts ON analytics(client_id, event_type, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_analytics_client_ts ON analytics(client_id, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_analytics_event_ts ON analytics(event_type, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bot_settings_client_name ON bot_settings(client_id, setting_name)")
+
+
+# Shard files version independently of the catalog
+SHARD_MIGRATIONS = [
+    (1, _shard_baseline),
+    (2, _migration_analytics_rollups),
+    (3, _migration_analytics_partitions),
+    (4, _migration_daily_sketches),
+    (5, _migration_faq_versions),
+]
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, migrations=MIGRATIONS):
+    """Applies pending migrations. Returns the list of versions applied."""
+    applied = []
+    for version, migration in migrations:
+        if get_schema_version(conn) >= version:
+            continue
+        # IMMEDIATE takes the write lock up front, so when several workers start at
+        # once only one migrates; the others wait and then see the new version
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(version)
+    return applied
+
+
+def init_all_db():
+    """
+    Brings the database schema up to date. Cheap when it already is:
+    a single PRAGMA read, no DDL.
+    """
+    conn = get_db_connection()
+    try:
+        if get_schema_version(conn) >= SCHEMA_VERSION:
+            return
+        applied = migrate(conn)
+    finally:
+        conn.close()
+    if applied:
+        print(f"✅ Database migrated to schema version {SCHEMA_VERSION} (applied {applied}).")
 
 
 # Initialize tables on import
@@ -214,22 +1020,35 @@ init_all_db()
 # ======================
 
 def read_faq(client_id=None, conn=None):
+    if not client_id:
+        rows = fan_out("SELECT question, answer, popular FROM faqs")
+        return {r["question"]: {"answer": r["answer"], "popular": bool(r["popular"])} for r in rows}
     close_conn = False
     if conn is None:
-        conn = get_db_connection()
+        conn = get_tenant_db(client_id)
         close_conn = True
-    if client_id:
-        rows = conn.execute("SELECT question, answer, popular FROM faqs WHERE client_id=?", (client_id,)).fetchall()
-    else:
-        rows = conn.execute("SELECT question, answer, popular FROM faqs").fetchall()
+    rows = conn.execute("SELECT question, answer, popular FROM faqs WHERE client_id=?", (client_id,)).fetchall()
     if close_conn:
         conn.close()
     return {r["question"]: {"answer": r["answer"], "popular": bool(r["popular"])} for r in rows}
 
 
+def get_faq_version(client_id, conn=None):
+    """The client's persisted FAQ version (0 before its first FAQ write)."""
+    close_conn = conn is None
+    if close_conn:
+        conn = get_tenant_db(client_id)
+    try:
+        row = conn.execute("SELECT version FROM faq_versions WHERE client_id=?", (client_id,)).fetchone()
+    finally:
+        if close_conn:
+            conn.close()
+    return row[0] if row else 0
+
+
 def is_client(email):
     with get_db() as conn:
-        row = conn.execute("SELECT 1 FROM clients WHERE LOWER(email)=LOWER(?)", (email.lower(),)).fetchone()
+        row = conn.execute("SELECT 1 FROM clients WHERE lower(email)=lower(?)", (email,)).fetchone()
         return bool(row)
 
 
@@ -238,18 +1057,26 @@ def get_client_id(email, conn=None):
     if conn is None:
         conn = get_db_connection()
         close_conn = True
-    row = conn.execute("SELECT id FROM clients WHERE LOWER(email)=LOWER(?)", (email.lower(),)).fetchone()
+    row = conn.execute("SELECT id FROM clients WHERE lower(email)=lower(?)", (email,)).fetchone()
     if close_conn:
         conn.close()
     return row["id"] if row else None
 
 
-def add_or_update_user_integration(email, code, conn=None):
+def get_client_identity(email):
+    """Return id, subscription_plan and status for the client with this email, or None."""
+    with get_db() as conn:
+        row = conn.execute("SELECT id, subscription_plan, status FROM clients WHERE lower(email)=lower(?)",
+                           (email,)).fetchone()
+    return dict(row) if row else None
+
+
+def add_or_update_user_integration(email, code, conn=None, client_id=None):
     close_conn = False
     if conn is None:
         conn = get_db_connection()
         close_conn = True
-    client_id = get_client_id(email, conn)
+    client_id = client_id or get_client_id(email, conn)
     if not client_id:
         if close_conn:
             conn.close()
@@ -261,25 +1088,266 @@ def add_or_update_user_integration(email, code, conn=None):
     else:
         conn.execute("INSERT INTO client_integrations (client_id, integration_code) VALUES (?, ?)", (client_id, code))
         action = "Added integration code"
-    conn.execute("INSERT INTO audit_logs (client_id, action, performed_by) VALUES (?, ?, ?)", (client_id, action, email))
     conn.commit()
     if close_conn:
         conn.close()
+    log_audit(client_id, action, performed_by=email, conn=None if close_conn else tenant_conn(client_id, conn))
 
 
 def delete_faq_in_db(client_id, question):
-    with get_db() as conn:
+    with get_tenant_db(client_id) as conn:
         conn.execute("DELETE FROM faqs WHERE client_id=? AND question=?", (client_id, question))
         conn.execute("INSERT INTO audit_logs (client_id, action, performed_by) VALUES (?, ?, ?)",
                      (client_id, f"Deleted FAQ: {question}", None))
         conn.commit()
 
 
-def log_audit(client_id, action, performed_by=None):
-    with get_db() as conn:
+def log_audit(client_id, action, performed_by=None, conn=None):
+    if conn is not None:
         conn.execute("INSERT INTO audit_logs (client_id, action, performed_by) VALUES (?, ?, ?)",
                      (client_id, action, performed_by))
         conn.commit()
+        return
+    with get_tenant_db(client_id) as conn:
+        conn.execute("INSERT INTO audit_logs (client_id, action, performed_by) VALUES (?, ?, ?)",
+                     (client_id, action, performed_by))
+        conn.commit()
+
+
+def save_faq(client_id, question, answer, popular=0):
+    """Insert or update a FAQ by (client_id, question)."""
+    with get_tenant_db(client_id) as conn:
+        conn.execute("""
+            INSERT INTO faqs (client_id, question, answer, popular)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(client_id, question) DO UPDATE SET
+                answer=excluded.answer,
+                popular=excluded.popular
+        """, (client_id, question, answer, popular))
+
+
+def delete_faq_by_id(client_id, faq_id):
+    """Delete a FAQ by id and audit it. Returns the deleted question, or None if it did not exist."""
+    with get_tenant_db(client_id) as conn:
+        row = conn.execute("SELECT question FROM faqs WHERE client_id=? AND id=?", (client_id, faq_id)).fetchone()
+        conn.execute("DELETE FROM faqs WHERE client_id=? AND id=?", (client_id, faq_id))
+        conn.execute("INSERT INTO audit_logs (client_id, action, performed_by) VALUES (?, ?, ?)",
+                     (client_id, f"Deleted FAQ ID: {faq_id}", None))
+    return row["question"] if row else None
+
+
+ANALYTICS_INSERT_SQL = """
+    INSERT INTO {table} (id, client_id, user_id, source, event_type, data, details, timestamp)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def analytics_row(client_id, event_type, details="", user_id=None, source="customer", data=None, timestamp=None):
+    """Parameters for ANALYTICS_INSERT_SQL, minus the id; details and data are stored as JSON."""
+    return (client_id, user_id, source, event_type,
+            json.dumps(data) if data is not None else None, json.dumps(details),
+            timestamp or datetime.utcnow().isoformat())
+
+
+def insert_analytics_event(client_id, event_type, details="", user_id=None, source="customer", data=None, timestamp=None):
+    """Insert one analytics row right away. Request handlers go through analytics_writer instead."""
+    insert_analytics_rows([analytics_row(client_id, event_type, details, user_id, source, data, timestamp)])
+
+
+def insert_analytics_rows(rows):
+    """
+    Insert analytics_row() tuples with one executemany and one commit per
+    tenant database, updating the rollups in the same transaction.
+    """
+    by_file = {}
+    for row in rows:
+        by_file.setdefault(tenant_db_file(row[0]), []).append(row)
+    for path, file_rows in by_file.items():
+        try:
+            _insert_partitioned(path, file_rows)
+        except sqlite3.OperationalError as e:
+            if "no such table" not in str(e):
+                raise
+            # A partition this process knew about was archived meanwhile
+            _known_partitions.pop(path, None)
+            _insert_partitioned(path, file_rows)
+
+
+def _insert_partitioned(path, rows):
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(analytics_partition_month(row[-1]), []).append(row)
+    known = _known_partitions.setdefault(path, set())
+    with PooledConnection(get_pool(path)) as conn:
+        # Reserve a block of ids; the UPDATE also takes the write lock up front
+        conn.execute("UPDATE analytics_ids SET last_id = last_id + ?", (len(rows),))
+        next_id = conn.execute("SELECT last_id FROM analytics_ids").fetchone()[0] - len(rows) + 1
+        for month, month_rows in by_month.items():
+            table = analytics_partition_table(month)
+            if month not in known:
+                ensure_analytics_partition(conn, month)
+            conn.executemany(ANALYTICS_INSERT_SQL.format(table=table),
+                             [(next_id + i, *row) for i, row in enumerate(month_rows)])
+            next_id += len(month_rows)
+        _update_analytics_rollups(conn, rows)
+    known.update(by_month)
+
+
+def _update_analytics_rollups(conn, rows):
+    totals, daily, users = {}, {}, set()
+    for client_id, user_id, _source, event_type, _data, _details, timestamp in rows:
+        client_id = int(client_id)
+        totals[client_id] = totals.get(client_id, 0) + 1
+        day = timestamp[:10]
+        key = (client_id, day, event_type or "")
+        daily[key] = daily.get(key, 0) + 1
+        if user_id is not None:
+            users.add((client_id, day, str(user_id)))
+
+    conn.executemany("""
+        INSERT INTO analytics_totals (client_id, events) VALUES (?, ?)
+        ON CONFLICT(client_id) DO UPDATE SET events = events + excluded.events
+    """, totals.items())
+    conn.executemany("""
+        INSERT INTO analytics_daily (client_id, day, event_type, count) VALUES (?, ?, ?, ?)
+        ON CONFLICT(client_id, day, event_type) DO UPDATE SET count = count + excluded.count
+    """, [(*key, n) for key, n in daily.items()])
+    conn.executemany("INSERT OR IGNORE INTO analytics_daily_users (client_id, day, user_id) VALUES (?, ?, ?)", users)
+
+    # Fold the batch's users into each day's sketch; re-adding a known user is a no-op
+    by_day = {}
+    for client_id, day, user_id in users:
+        by_day.setdefault((client_id, day), []).append(user_id)
+    for (client_id, day), day_users in by_day.items():
+        row = conn.execute("SELECT sketch FROM analytics_daily_sketches WHERE client_id=? AND day=?",
+                           (client_id, day)).fetchone()
+        sketch = HyperLogLog.from_bytes(row[0]) if row else HyperLogLog()
+        if sketch.update(day_users) or not row:
+            conn.execute("INSERT OR REPLACE INTO analytics_daily_sketches (client_id, day, sketch) VALUES (?, ?, ?)",
+                         (client_id, day, sketch.to_bytes()))
+
+
+ANALYTICS_EVENT_COLUMNS = ("id", "timestamp", "event_type", "user_id", "source", "details", "data")
+
+
+def read_analytics_events(client_id, after=None, limit=100, event_type=None, start=None, end=None):
+    """
+    One page of the client's raw events in (timestamp, id) order, starting
+    after the (timestamp, id) pair 'after', optionally within [start, end).
+    Keyset pagination: every page is an index range scan on (client_id,
+    timestamp) in the first partitions of the range, however deep it is.
+    """
+    sql = f"SELECT {', '.join(ANALYTICS_EVENT_COLUMNS)} FROM {{table}} WHERE client_id=?"
+    params = [client_id]
+    if after is not None:
+        sql += " AND (timestamp, id) > (?, ?)"
+        params.extend(after)
+    if start:
+        sql += " AND timestamp >= ?"
+        params.append(start)
+    if end:
+        sql += " AND timestamp < ?"
+        params.append(end)
+    if event_type:
+        sql += " AND event_type=?"
+        params.append(event_type)
+    sql += " ORDER BY timestamp, id LIMIT ?"
+
+    # Partitions are disjoint, ordered month ranges: read them in order until the page is full
+    first = max(str(after[0]), start or "") if after is not None else start
+    rows = []
+    conn = get_tenant_db(client_id)
+    try:
+        for table in analytics_partition_tables(conn, first, end):
+            rows.extend(conn.execute(sql.format(table=table), (*params, limit - len(rows))).fetchall())
+            if len(rows) >= limit:
+                break
+        return rows
+    finally:
+        conn.close()
+
+
+def count_active_users(client_id, start=None, end=None, exact=False, conn=None):
+    """
+    Distinct users with events on days in [start, end) ('YYYY-MM-DD', either may be None).
+    By default merges the daily HyperLogLog sketches (about 1.6% standard
+    error, see hll.py); exact=True counts the stored user sets instead, for
+    billing, at a cost that grows with traffic.
+    """
+    where, params = "client_id=?", [client_id]
+    if start:
+        where += " AND day >= ?"
+        params.append(start)
+    if end:
+        where += " AND day < ?"
+        params.append(end)
+    close_conn = conn is None
+    conn = conn or get_tenant_db(client_id)
+    try:
+        if exact:
+            return conn.execute(f"SELECT COUNT(DISTINCT user_id) FROM analytics_daily_users WHERE {where}",
+                                params).fetchone()[0]
+        blobs = [r[0] for r in conn.execute(f"SELECT sketch FROM analytics_daily_sketches WHERE {where}", params)]
+        return HyperLogLog.union(blobs).count()
+    finally:
+        if close_conn:
+            conn.close()
+
+
+def get_analytics_summary(client_id, days=30):
+    """Dashboard numbers for the client, read from the rollups only."""
+    since = (datetime.utcnow() - timedelta(days=days)).date().isoformat()
+    conn = get_tenant_db(client_id)
+    try:
+        row = conn.execute("SELECT events FROM analytics_totals WHERE client_id=?", (client_id,)).fetchone()
+        total = row["events"] if row else 0
+        active_users = count_active_users(client_id, start=since, conn=conn)
+        daily = conn.execute("""
+            SELECT day,
+                   SUM(CASE WHEN event_type='faq_click' THEN count ELSE 0 END) AS faq_count,
+                   SUM(CASE WHEN event_type='ai_request' THEN count ELSE 0 END) AS ai_count
+            FROM analytics_daily
+            WHERE client_id=? AND day >= ?
+            GROUP BY day
+            ORDER BY day
+        """, (client_id, since)).fetchall()
+    finally:
+        conn.close()
+    return {
+        "total_interactions": total,
+        "active_users": active_users or 0,
+        "daily": {
+            "labels": [r["day"] for r in daily],
+            "faq_counts": [r["faq_count"] for r in daily],
+            "ai_counts": [r["ai_count"] for r in daily],
+        },
+    }
+
+
+def get_bot_setting(client_id, setting_name, default=None):
+    """Return the latest bot_settings value for the client, or default if unset."""
+    conn = get_tenant_db(client_id)
+    try:
+        row = conn.execute(
+            "SELECT setting_value FROM bot_settings WHERE client_id=? AND setting_name=? ORDER BY id DESC LIMIT 1",
+            (client_id, setting_name)
+        ).fetchone()
+        return row["setting_value"] if row and row["setting_value"] is not None else default
+    finally:
+        conn.close()
+
+
+def month_bounds(now=None):
+    """
+    Returns ('YYYY-MM-01', first day of next month) for the current UTC month.
+    Date-only bounds compare correctly against both ISO ('T') and
+    CURRENT_TIMESTAMP (' ') timestamps.
+    """
+    now = now or datetime.utcnow()
+    start = now.date().replace(day=1)
+    following = (start.replace(year=start.year + 1, month=1) if start.month == 12
+                 else start.replace(month=start.month + 1))
+    return start.isoformat(), following.isoformat()
 
 
 # ======================
@@ -298,33 +1366,110 @@ def get_user_plan(client_id: int) -> str:
         conn.close()
 
 
+def get_plan_entitlements():
+    """Returns {plan: row} from plan_entitlements; quota.py caches it."""
+    conn = get_db_connection()
+    try:
+        return {row["plan"]: row for row in conn.execute("SELECT * FROM plan_entitlements")}
+    finally:
+        conn.close()
+
+
 def get_faq_count(client_id: int) -> int:
     """
     Returns the maximum allowed FAQs for a given client based on their subscription plan.
     """
-    plan = get_user_plan(client_id).lower()
-    limits = {
-        "demo": 5,
-        "onetime": 20,
-        "basic": 50,
-        "standard": 100,
-        "premium": 200
-    }
-    return limits.get(plan, 5)
+    # Import here to avoid circular import
+    from quota import entitlements
+    return entitlements.get(get_user_plan(client_id)).max_faqs
 
 
-def get_ai_request_count(client_id: int) -> int:
-    """Return how many AI requests the client has used this month"""
-    conn = get_db_connection()
+def get_ai_request_count(client_id: int, month: str = None, conn=None) -> int:
+    """Return how many AI requests the client has used this month, as last persisted"""
+    month = month or month_bounds()[0][:7]
+    close_conn = conn is None
+    if close_conn:
+        conn = get_tenant_db(client_id)
     try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT COUNT(*) as used
-            FROM analytics
-            WHERE client_id=? AND event_type='ai_request'
-            AND strftime('%Y-%m', timestamp) = strftime('%Y-%m','now')
-        """, (client_id,))
-        row = cur.fetchone()
-        return row["used"] or 0
+        row = conn.execute("SELECT requests FROM ai_usage_monthly WHERE client_id=? AND month=?",
+                           (client_id, month)).fetchone()
+        return row["requests"] if row else 0
     finally:
-        conn.close()
+        if close_conn:
+            conn.close()
+
+
+def add_ai_usage(deltas):
+    """
+    Adds {(client_id, 'YYYY-MM'): n} to ai_usage_monthly, one transaction per
+    tenant database. Returns the stored totals for those keys afterwards; keys
+    with n == 0 are only read.
+    """
+    by_file = {}
+    for (client_id, month), n in deltas.items():
+        by_file.setdefault(tenant_db_file(client_id), []).append((int(client_id), month, n))
+    totals = {}
+    for path, rows in by_file.items():
+        with PooledConnection(get_pool(path)) as conn:
+            conn.executemany("""
+                INSERT INTO ai_usage_monthly (client_id, month, requests) VALUES (?, ?, ?)
+                ON CONFLICT(client_id, month) DO UPDATE SET requests = requests + excluded.requests
+            """, [r for r in rows if r[2]])
+            for client_id, month, _n in rows:
+                row = conn.execute("SELECT requests FROM ai_usage_monthly WHERE client_id=? AND month=?",
+                                   (client_id, month)).fetchone()
+                totals[(client_id, month)] = row["requests"] if row else 0
+    return totals
+
+
+# ======================
+# ASYNC DATA ACCESS
+# ======================
+# sqlite3 blocks, so async handlers run queries on this bounded executor
+# instead of the event loop. Sized to the connection pool by default.
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(DB_POOL_SIZE)))
+
+_db_executor = None
+_db_executor_pid = None
+
+
+def _get_db_executor():
+    global _db_executor, _db_executor_pid
+    if _db_executor is None or _db_executor_pid != os.getpid():
+        _db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+        _db_executor_pid = os.getpid()
+    return _db_executor
+
+
+async def run_db(fn, *args, **kwargs):
+    """Runs a blocking DB function on the DB executor and awaits its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_db_executor(), partial(fn, *args, **kwargs))
+
+
+async def read_faq_async(client_id=None):
+    return await run_db(read_faq, client_id)
+
+
+async def is_client_async(email):
+    return await run_db(is_client, email)
+
+
+async def get_client_id_async(email):
+    return await run_db(get_client_id, email)
+
+
+async def log_audit_async(client_id, action, performed_by=None):
+    return await run_db(log_audit, client_id, action, performed_by)
+
+
+async def save_faq_async(client_id, question, answer, popular=0):
+    return await run_db(save_faq, client_id, question, answer, popular)
+
+
+async def delete_faq_by_id_async(client_id, faq_id):
+    return await run_db(delete_faq_by_id, client_id, faq_id)
+
+
+async def insert_analytics_event_async(client_id, event_type, details="", user_id=None, source="customer", data=None, timestamp=None):
+    return await run_db(insert_analytics_event, client_id, event_type, details, user_id, source, data, timestamp)
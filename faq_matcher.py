@@ -0,0 +1,392 @@
+import itertools
+import math
+import os
+import threading
+import time
+import numpy as np
+from rapidfuzz import process, fuzz, utils
+from db import get_tenant_db, get_bot_setting, get_faq_version, run_db
+
+# Minimum score for a fuzzy FAQ match (shared with main.py)
+MAX_FAQ_MATCH_SCORE = 65
+
+# Max candidates passed to the fuzzy scorers once a corpus outgrows FAQ_PRUNE_MIN_FAQS.
+# Override per client with the 'faq_candidate_k' bot setting; 0 disables pruning.
+FAQ_CANDIDATE_K = int(os.getenv("FAQ_CANDIDATE_K", "200"))
+# Below this many questions one cdist over the whole corpus beats pruning (see benchmark_matching.py)
+FAQ_PRUNE_MIN_FAQS = int(os.getenv("FAQ_PRUNE_MIN_FAQS", "1000"))
+
+# How often a cached matcher re-reads the persisted FAQ version to pick up other workers' writes
+FAQ_VERSION_CHECK_SECONDS = float(os.getenv("FAQ_VERSION_CHECK_SECONDS", "2"))
+
+# Rebuild a matcher's gram index once this share of its slots belongs to removed questions
+FAQ_INDEX_MAX_TOMBSTONES = float(os.getenv("FAQ_INDEX_MAX_TOMBSTONES", "0.5"))
+
+# Upper bound on cells in one cdist score matrix (float64, so 8 bytes each);
+# larger batches are scored in row chunks
+FAQ_CDIST_MAX_CELLS = int(os.getenv("FAQ_CDIST_MAX_CELLS", "2000000"))
+
+_NO_CANDIDATES = object()
+
+# Process-wide so a rebuilt matcher never reuses an old matcher's version
+_versions = itertools.count(1)
+
+
+# ======================
+# QUESTION PREPROCESSING
+# ======================
+def normalize(text):
+    """Lowercases and strips punctuation (rapidfuzz's default_process)."""
+    return utils.default_process(text or "")
+
+
+def sort_tokens(normalized):
+    """token_sort_ratio(a, b) == ratio(sort_tokens(a), sort_tokens(b)) for normalized input."""
+    return " ".join(sorted(normalized.split()))
+
+
+class _Corpus:
+    """Immutable snapshot of a client's questions, preprocessed once for cdist."""
+
+    __slots__ = ("questions", "normalized", "sorted")
+
+    def __init__(self, questions, normalized, sorted_):
+        self.questions = questions
+        self.normalized = normalized
+        self.sorted = sorted_
+
+    @classmethod
+    def build(cls, questions):
+        questions = list(questions)
+        normalized = [normalize(q) for q in questions]
+        return cls(questions, normalized, [sort_tokens(n) for n in normalized])
+
+    def append(self, question):
+        norm = normalize(question)
+        return _Corpus(self.questions + [question], self.normalized + [norm], self.sorted + [sort_tokens(norm)])
+
+    def without(self, question):
+        i = self.questions.index(question)
+        return _Corpus(
+            self.questions[:i] + self.questions[i + 1:],
+            self.normalized[:i] + self.normalized[i + 1:],
+            self.sorted[:i] + self.sorted[i + 1:],
+        )
+
+
+# ======================
+# CANDIDATE INDEX
+# ======================
+def grams(normalized):
+    """Whole tokens plus padded character trigrams of each token."""
+    out = set()
+    for token in normalized.split():
+        out.add(token)
+        padded = f" {token} "
+        out.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return out
+
+
+class _GramIndex:
+    """
+    Inverted index from tokens/trigrams to questions, used to pick the top-K
+    candidates before fuzzy scoring. Questions get integer slots and postings
+    are numpy arrays of slots, so candidate scoring is one bincount instead of
+    a Python loop over every posting. Postings are replaced, never mutated,
+    so readers can use them without holding the matcher lock.
+    """
+
+    def __init__(self, items=()):
+        self.slots = []  # slot -> question, None once removed
+        self.tombstones = 0
+        self._slot_of = {}  # {question: slot}
+        # Bulk build with plain lists, then freeze; add() per item would copy postings each time
+        postings = {}
+        for question, normalized in items:
+            slot = self._new_slot(question)
+            for g in grams(normalized):
+                postings.setdefault(g, []).append(slot)
+        self.postings = {g: np.array(slots, dtype=np.int32) for g, slots in postings.items()}  # {gram: slots}
+
+    def _new_slot(self, question):
+        slot = len(self.slots)
+        self.slots.append(question)
+        self._slot_of[question] = slot
+        return slot
+
+    def add(self, question, normalized):
+        slot = self._new_slot(question)
+        for g in grams(normalized):
+            posting = self.postings.get(g)
+            self.postings[g] = np.append(posting, slot) if posting is not None else np.array([slot], dtype=np.int32)
+
+    def remove(self, question, normalized):
+        slot = self._slot_of.pop(question, None)
+        if slot is None:
+            return
+        self.slots[slot] = None
+        self.tombstones += 1
+        for g in grams(normalized):
+            posting = self.postings.get(g)
+            if posting is None:
+                continue
+            posting = posting[posting != slot]
+            if len(posting):
+                self.postings[g] = posting
+            else:
+                self.postings.pop(g, None)
+
+    def candidates(self, normalized, k, size):
+        # Grams shared by a large share of the corpus say little about relevance
+        max_df = max(k, size // 4)
+        postings, weights = [], []
+        for g in grams(normalized):
+            posting = self.postings.get(g)
+            if posting is None or len(posting) > max_df:
+                continue
+            postings.append(posting)
+            weights.append(math.log(1 + size / len(posting)))
+        if not postings:
+            return []
+
+        slots = self.slots
+        scores = np.bincount(
+            np.concatenate(postings),
+            weights=np.repeat(weights, [len(p) for p in postings]),
+        )
+        top = np.flatnonzero(scores)
+        if len(top) > k:
+            top = top[np.argpartition(scores[top], -k)[-k:]]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [slots[i] for i in top if slots[i] is not None]
+
+
+# ======================
+# PER-CLIENT FAQ MATCHER
+# ======================
+class FaqMatcher:
+    """
+    In-memory FAQ corpus for a single client.
+    Built once from the faqs table and kept up to date by the FAQ write endpoints,
+    so a chat turn never has to hit the database to get the corpus. Writes made
+    by other workers are picked up through the persisted faq_versions counter.
+    """
+
+    def __init__(self, client_id, rows=(), candidate_k=FAQ_CANDIDATE_K, db_version=0):
+        self.client_id = client_id
+        self.candidate_k = candidate_k
+        self._lock = threading.Lock()
+        self.version = next(_versions)  # changes on every write; used by reply_cache
+        self.db_version = db_version  # faq_versions row the corpus was loaded at
+        self.checked_at = time.monotonic()
+        self._answers = {row["question"]: row["answer"] for row in rows}
+        self._corpus = _Corpus.build(self._answers)  # swapped atomically on write
+        self._prepared = dict(zip(self._corpus.questions, zip(self._corpus.normalized, self._corpus.sorted)))
+        self._index = _GramIndex((question, norm) for question, (norm, _) in self._prepared.items())
+
+    def __len__(self):
+        return len(self._corpus.questions)
+
+    def upsert(self, question, answer):
+        with self._lock:
+            if question not in self._answers:
+                self._corpus = self._corpus.append(question)
+                norm = self._corpus.normalized[-1]
+                self._prepared[question] = (norm, self._corpus.sorted[-1])
+                self._index.add(question, norm)
+            self._answers[question] = answer
+            self.version = next(_versions)
+
+    def remove(self, question):
+        with self._lock:
+            if self._answers.pop(question, None) is not None:
+                self._corpus = self._corpus.without(question)
+                norm, _ = self._prepared.pop(question)
+                self._index.remove(question, norm)
+                if self._index.tombstones > FAQ_INDEX_MAX_TOMBSTONES * len(self._index.slots):
+                    # Slots are never reused; start over with only the live questions
+                    self._index = _GramIndex((q, n) for q, (n, _) in self._prepared.items())
+                self.version = next(_versions)
+
+    def match(self, message):
+        """
+        Returns (question, answer, score) for the best FAQ match, or None.
+        Tries token_sort_ratio first and falls back to partial_ratio.
+        """
+        return self.match_many([message])[0]
+
+    def match_many(self, messages):
+        """
+        Scores a batch of messages against the corpus with one cdist call per scorer.
+        partial_ratio is only computed for messages that token_sort_ratio did not match.
+        """
+        corpus = self._corpus
+        results = [None] * len(messages)
+        if not messages or not corpus.questions:
+            return results
+
+        normalized = [normalize(m) for m in messages]
+        if not (self.candidate_k and len(corpus.questions) > max(self.candidate_k, FAQ_PRUNE_MIN_FAQS)):
+            return self._match_brute(corpus, normalized)
+
+        unpruned = []
+        for i, norm in enumerate(normalized):
+            results[i] = self._match_pruned(norm)
+            if results[i] is _NO_CANDIDATES:
+                unpruned.append(i)
+        # Only frequent (or unknown) grams: the index cannot rank these, so score them against everything
+        if unpruned:
+            for i, result in zip(unpruned, self._match_brute(corpus, [normalized[i] for i in unpruned])):
+                results[i] = result
+        return results
+
+    def _match_brute(self, corpus, normalized):
+        """Scores normalized messages against the whole corpus, FAQ_CDIST_MAX_CELLS scores at a time."""
+        rows = max(1, FAQ_CDIST_MAX_CELLS // len(corpus.questions))
+        if len(normalized) > rows:
+            results = []
+            for start in range(0, len(normalized), rows):
+                results.extend(self._match_brute(corpus, normalized[start:start + rows]))
+            return results
+
+        results = [None] * len(normalized)
+        scores = process.cdist(
+            [sort_tokens(n) for n in normalized], corpus.sorted,
+            scorer=fuzz.ratio, processor=None, score_cutoff=MAX_FAQ_MATCH_SCORE, dtype=np.float64,
+        )
+        best = scores.argmax(axis=1)
+        misses = []
+        for i, j in enumerate(best):
+            if scores[i, j] >= MAX_FAQ_MATCH_SCORE:
+                results[i] = self._result(corpus, j, scores[i, j])
+            else:
+                misses.append(i)
+
+        if misses:
+            scores = process.cdist(
+                [normalized[i] for i in misses], corpus.normalized,
+                scorer=fuzz.partial_ratio, processor=None, score_cutoff=MAX_FAQ_MATCH_SCORE, dtype=np.float64,
+            )
+            best = scores.argmax(axis=1)
+            for row, (i, j) in enumerate(zip(misses, best)):
+                if scores[row, j] >= MAX_FAQ_MATCH_SCORE:
+                    results[i] = self._result(corpus, j, scores[row, j])
+        return results
+
+    def _match_pruned(self, normalized):
+        """
+        Scores only the top-K candidates from the gram index, same thresholds as brute force.
+        Returns _NO_CANDIDATES when the index has nothing selective to offer.
+        """
+        candidates = self._index.candidates(normalized, self.candidate_k, len(self._corpus.questions))
+        prepared = [self._prepared.get(q) for q in candidates]
+        candidates = [q for q, p in zip(candidates, prepared) if p is not None]
+        prepared = [p for p in prepared if p is not None]
+        if not candidates:
+            return _NO_CANDIDATES
+
+        best = process.extractOne(
+            sort_tokens(normalized), [p[1] for p in prepared],
+            scorer=fuzz.ratio, processor=None, score_cutoff=MAX_FAQ_MATCH_SCORE,
+        )
+        if best is None:
+            best = process.extractOne(
+                normalized, [p[0] for p in prepared],
+                scorer=fuzz.partial_ratio, processor=None, score_cutoff=MAX_FAQ_MATCH_SCORE,
+            )
+        if best is None:
+            return None
+        return self._answer(candidates[best[2]], best[1])
+
+    def _result(self, corpus, index, score):
+        return self._answer(corpus.questions[index], score)
+
+    def _answer(self, question, score):
+        answer = self._answers.get(question)
+        if answer is None:
+            return None
+        return question, answer, float(score)
+
+
+# ======================
+# MATCHER REGISTRY
+# ======================
+_matchers = {}  # {client_id: FaqMatcher}
+_matchers_lock = threading.Lock()
+
+
+def _key(client_id):
+    # client_id arrives as int from the session and as str from form/JSON bodies
+    return int(client_id)
+
+
+def _candidate_k(client_id):
+    value = get_bot_setting(client_id, "faq_candidate_k")
+    try:
+        return int(value) if value is not None else FAQ_CANDIDATE_K
+    except ValueError:
+        return FAQ_CANDIDATE_K
+
+
+def _fresh(matcher):
+    return matcher is not None and time.monotonic() - matcher.checked_at < FAQ_VERSION_CHECK_SECONDS
+
+
+def get_matcher(client_id):
+    """
+    Returns the client's matcher, loading it from the database on first use.
+    At most every FAQ_VERSION_CHECK_SECONDS it compares the persisted FAQ version
+    and reloads if another worker changed the FAQs.
+    """
+    key = _key(client_id)
+    matcher = _matchers.get(key)
+    if _fresh(matcher):
+        return matcher
+    if matcher is not None and get_faq_version(key) == matcher.db_version:
+        matcher.checked_at = time.monotonic()
+        return matcher
+
+    with _matchers_lock:
+        current = _matchers.get(key)
+        if current is None or current is matcher:
+            conn = get_tenant_db(key)
+            try:
+                # Version first: a write landing in between only causes one extra reload
+                db_version = get_faq_version(key, conn)
+                rows = conn.execute("SELECT question, answer FROM faqs WHERE client_id=?", (key,)).fetchall()
+            finally:
+                conn.close()
+            current = FaqMatcher(key, rows, candidate_k=_candidate_k(key), db_version=db_version)
+            _matchers[key] = current
+    return current
+
+
+async def get_matcher_async(client_id):
+    """Like get_matcher, but version checks and loads run on the DB executor instead of the event loop."""
+    matcher = _matchers.get(_key(client_id))
+    if _fresh(matcher):
+        return matcher
+    return await run_db(get_matcher, client_id)
+
+
+def faq_saved(client_id, question, answer):
+    """Call after a FAQ row is inserted or updated."""
+    matcher = _matchers.get(_key(client_id))
+    if matcher is not None:
+        matcher.upsert(question, answer)
+
+
+def faq_deleted(client_id, question):
+    """Call after a FAQ row is deleted."""
+    matcher = _matchers.get(_key(client_id))
+    if matcher is not None:
+        matcher.remove(question)
+
+
+def invalidate_matcher(client_id=None):
+    """Drops a client's matcher (or all of them) so it is rebuilt on next use, e.g. after its bot settings change."""
+    with _matchers_lock:
+        if client_id is None:
+            _matchers.clear()
+        else:
+            _matchers.pop(_key(client_id), None)
@@ -0,0 +1,107 @@
+# hll.py
+# HyperLogLog distinct counter. Sketches are fixed-size register arrays that
+# merge by element-wise max, so per-day sketches can be combined into any
+# date range without touching the underlying ids.
+import hashlib
+import math
+import os
+import zlib
+import numpy as np
+
+# 2**p registers; relative standard error is about 1.04 / sqrt(2**p) (1.6% at p=12)
+HLL_PRECISION = int(os.getenv("HLL_PRECISION", "12"))
+
+
+def _hash64(value):
+    # Stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HyperLogLog:
+    """Mergeable approximate distinct counter."""
+
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = registers if registers is not None else np.zeros(self.m, dtype=np.uint8)
+
+    @property
+    def error(self):
+        """Relative standard error of count()."""
+        return 1.04 / math.sqrt(self.m)
+
+    def add(self, value):
+        """Adds one id; returns True if the sketch changed."""
+        h = _hash64(value)
+        bits = 64 - self.precision
+        index = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def update(self, values):
+        changed = False
+        for value in values:
+            changed = self.add(value) or changed
+        return changed
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("cannot merge sketches of different precision; downsample() the larger one")
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def downsample(self, precision):
+        """
+        The same sketch at a lower precision, as if every id had been added to it.
+        The index bits dropped become the leading bits of each register's hash suffix.
+        """
+        if precision > self.precision:
+            raise ValueError("cannot raise a sketch's precision")
+        if precision == self.precision:
+            return HyperLogLog(precision, self.registers.copy())
+        d = self.precision - precision
+        low = np.arange(self.m) & ((1 << d) - 1)
+        # Position of the first 1 in the dropped bits, else past them plus the old rank
+        first_one = d - np.floor(np.log2(np.maximum(low, 1))).astype(np.int64)
+        ranks = np.where(low != 0, first_one, d + self.registers.astype(np.int64))
+        ranks[self.registers == 0] = 0
+        return HyperLogLog(precision, ranks.reshape(1 << precision, 1 << d).max(axis=1).astype(np.uint8))
+
+    def count(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / float(np.sum(np.exp2(-self.registers.astype(np.float64))))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        # Small ranges: linear counting is far more accurate while registers are still empty
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    # ----------------------------
+    # Storage
+    # ----------------------------
+    def to_bytes(self):
+        """One precision byte, then the zlib-compressed registers (a few bytes for quiet days)."""
+        return bytes([self.precision]) + zlib.compress(self.registers.tobytes())
+
+    @classmethod
+    def from_bytes(cls, blob):
+        precision = blob[0]
+        registers = np.frombuffer(zlib.decompress(blob[1:]), dtype=np.uint8).copy()
+        return cls(precision, registers)
+
+    @classmethod
+    def union(cls, blobs, precision=HLL_PRECISION):
+        """
+        Merges stored sketches into one; an empty sketch when there are none.
+        Sketches stored before an HLL_PRECISION change are merged at the lowest precision among them.
+        """
+        sketches = [cls.from_bytes(blob) for blob in blobs]
+        if not sketches:
+            return cls(precision)
+        lowest = min(s.precision for s in sketches)
+        arrays = [s.registers if s.precision == lowest else s.downsample(lowest).registers for s in sketches]
+        return cls(lowest, np.maximum.reduce(arrays))
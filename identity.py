@@ -0,0 +1,121 @@
+# identity.py
+# Resolves the logged-in session user to (client_id, plan, status) once, and
+# keeps the result in the session and an in-process TTL cache so handlers do
+# not re-query clients on every request.
+import os
+import threading
+import time
+from typing import NamedTuple
+from fastapi import HTTPException, Request
+from db import get_client_identity, run_db
+
+# Seconds a resolved identity is trusted before it is re-read from the database
+IDENTITY_CACHE_TTL = float(os.getenv("IDENTITY_CACHE_TTL", "60"))
+SESSION_KEY = "identity"
+
+
+class Identity(NamedTuple):
+    client_id: int
+    plan: str
+    status: str
+    email: str
+
+
+class IdentityCache:
+    """
+    email -> (loaded_at, Identity) with a TTL. Invalidating an email also
+    records when it happened, so copies stored in sessions before that
+    moment are ignored too.
+    """
+
+    def __init__(self, ttl=IDENTITY_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._invalidated = {}  # {email: time of last invalidation}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, email):
+        """Returns (loaded_at, Identity) or None."""
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry and time.time() - entry[0] < self.ttl:
+                self.hits += 1
+                return entry
+            self._entries.pop(email, None)
+            self.misses += 1
+            return None
+
+    def put(self, email, loaded_at, identity):
+        with self._lock:
+            if loaded_at > self._invalidated.get(email, 0):
+                self._entries[email] = (loaded_at, identity)
+
+    def is_current(self, email, loaded_at):
+        """Whether something loaded at loaded_at is still fresh and not invalidated since."""
+        return time.time() - loaded_at < self.ttl and loaded_at > self._invalidated.get(email, 0)
+
+    def invalidate(self, email=None):
+        with self._lock:
+            if email is None:
+                self._entries.clear()
+                return
+            email = email.lower()
+            self._entries.pop(email, None)
+            self._invalidated[email] = time.time()
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses, "ttl": self.ttl}
+
+
+identity_cache = IdentityCache()
+
+
+def invalidate_identity(email=None):
+    """Call after changing a client's email, plan or status (None clears everything)."""
+    identity_cache.invalidate(email)
+
+
+async def resolve_identity(request: Request):
+    """Returns the session user's Identity, or None if not logged in or not a client."""
+    user = request.session.get("user")
+    email = user.get("email") if user else None
+    if not email:
+        return None
+    key = email.lower()
+
+    stored = request.session.get(SESSION_KEY)
+    if stored and stored.get("email") == key and identity_cache.is_current(key, stored["loaded_at"]):
+        return Identity(stored["client_id"], stored["plan"], stored["status"], email)
+
+    entry = identity_cache.get(key)
+    if entry is None:
+        loaded_at = time.time()
+        row = await run_db(get_client_identity, email)
+        if row is None:
+            request.session.pop(SESSION_KEY, None)
+            return None
+        entry = (loaded_at, Identity(row["id"], row["subscription_plan"], row["status"], email))
+        identity_cache.put(key, *entry)
+
+    loaded_at, identity = entry
+    request.session[SESSION_KEY] = {"email": key, "loaded_at": loaded_at, "client_id": identity.client_id,
+                                    "plan": identity.plan, "status": identity.status}
+    return identity._replace(email=email)
+
+
+# ----------------------------
+# FastAPI dependencies
+# ----------------------------
+async def optional_client(request: Request):
+    """Identity or None; for pages that redirect instead of failing."""
+    return await resolve_identity(request)
+
+
+async def require_client(request: Request) -> Identity:
+    """Identity of the logged-in client, or 403."""
+    identity = await resolve_identity(request)
+    if identity is None:
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    return identity
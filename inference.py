@@ -0,0 +1,221 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from models_utils import get_model_version
+
+# Number of inference worker processes; 0 runs inference on a thread in this process
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "2"))
+# How long to collect concurrent fallback messages per client, and the max batch size
+AI_BATCH_WINDOW_MS = float(os.getenv("AI_BATCH_WINDOW_MS", "10"))
+AI_BATCH_MAX_SIZE = int(os.getenv("AI_BATCH_MAX_SIZE", "16"))
+# Workers start fresh instead of forking a parent that holds threads, pooled SQLite connections and models
+INFERENCE_START_METHOD = os.getenv("INFERENCE_START_METHOD", "spawn")
+# How long /admin/model_cache waits for a busy worker's stats
+INFERENCE_STATS_TIMEOUT = float(os.getenv("INFERENCE_STATS_TIMEOUT", "5"))
+
+
+# ======================
+# WORKER-SIDE FUNCTIONS
+# ======================
+# These run inside the worker processes, each of which keeps its own
+# models_utils.model_cache, so MODEL_CACHE_MAX_MB applies per worker.
+# The model version comes from the parent process, where FAQ/model writes happen,
+# so a worker never keeps serving a model whose files have changed.
+def _infer(client_id, messages, model_version):
+    from models_utils import load_client_model
+    return list(load_client_model(client_id, model_version)(messages))
+
+
+def _warm(client_id, model_version):
+    from models_utils import load_client_model
+    load_client_model(client_id, model_version)
+
+
+def _loaded_keys():
+    from models_utils import model_cache
+    return model_cache.keys()
+
+
+def _stats():
+    from models_utils import model_cache
+    return {"pid": os.getpid(), **model_cache.stats()}
+
+
+# ======================
+# INFERENCE POOL
+# ======================
+class InferencePool:
+    """
+    Runs model inference off the event loop. Each worker is a single-process
+    executor and a client is always routed to the same worker, so that
+    worker's model cache stays hot for it.
+    """
+
+    def __init__(self, workers=INFERENCE_WORKERS, start_method=INFERENCE_START_METHOD):
+        self.workers = workers
+        self._mp_context = multiprocessing.get_context(start_method)
+        self._executors = [None] * workers  # created lazily so importing never starts processes
+        # Prewarm and the first requests race to create the same worker; the loser's would leak
+        self._lock = threading.Lock()
+
+    def _executor_for(self, client_id):
+        index = int(client_id) % self.workers
+        executor = self._executors[index]
+        if executor is None:
+            with self._lock:
+                executor = self._executors[index]
+                if executor is None:
+                    executor = self._executors[index] = ProcessPoolExecutor(max_workers=1, mp_context=self._mp_context)
+        return index, executor
+
+    def _submit(self, client_id, fn, *args):
+        index, executor = self._executor_for(client_id)
+        try:
+            return executor.submit(fn, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM while building a model); start a fresh one
+            with self._lock:
+                if self._executors[index] is executor:
+                    self._executors[index] = None
+            executor.shutdown(wait=False, cancel_futures=True)
+            return self._executor_for(client_id)[1].submit(fn, *args)
+
+    async def infer(self, client_id, messages):
+        """Returns the model's answers for a list of messages without blocking the event loop."""
+        model_version = get_model_version(client_id)
+        if self.workers <= 0:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, _infer, client_id, messages, model_version)
+        return await asyncio.wrap_future(self._submit(client_id, _infer, client_id, messages, model_version))
+
+    def warm(self, client_id):
+        """Blocking: loads the client's model in the worker that serves it."""
+        model_version = get_model_version(client_id)
+        if self.workers <= 0:
+            return _warm(client_id, model_version)
+        return self._submit(client_id, _warm, client_id, model_version).result()
+
+    def worker_index(self, client_id):
+        return int(client_id) % self.workers if self.workers > 0 else 0
+
+    def loaded_keys(self, client_id, timeout=INFERENCE_STATS_TIMEOUT):
+        """Cache keys of the models loaded in the worker that serves the client (used by model prewarm)."""
+        if self.workers <= 0:
+            return _loaded_keys()
+        return self._submit(client_id, _loaded_keys).result(timeout)
+
+    def stats(self, timeout=INFERENCE_STATS_TIMEOUT):
+        if self.workers <= 0:
+            return [_stats()]
+        futures, out = [], []
+        for index, executor in enumerate(self._executors):
+            if executor is None:
+                continue
+            try:
+                futures.append((index, executor.submit(_stats)))
+            except BrokenProcessPool:
+                # Died since its last task; it is replaced on the next request it serves
+                out.append({"worker": index, "error": "worker down"})
+        for index, future in futures:
+            try:
+                out.append({"worker": index, **future.result(timeout=timeout)})
+            except FutureTimeout:
+                # Busy (e.g. building a model); its stats request stays queued behind that work
+                out.append({"worker": index, "error": f"no reply within {timeout}s"})
+            except BrokenProcessPool:
+                out.append({"worker": index, "error": "worker down"})
+        return sorted(out, key=lambda worker: worker["worker"])
+
+    def shutdown(self):
+        with self._lock:
+            executors, self._executors = self._executors, [None] * self.workers
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+
+inference_pool = InferencePool()
+
+
+# ======================
+# MICRO-BATCHING
+# ======================
+class MicroBatcher:
+    """
+    Collects concurrent single-message inference requests for the same client
+    for up to window_ms (or until max_size are waiting), runs them through the
+    model as one batch and hands each caller its own answer.
+    Must be used from a single event loop.
+    """
+
+    def __init__(self, pool, window_ms=AI_BATCH_WINDOW_MS, max_size=AI_BATCH_MAX_SIZE):
+        self.pool = pool
+        self.window = window_ms / 1000
+        self.max_size = max_size
+        self._pending = {}  # {client_id: [(message, future)]}
+        self._timers = {}   # {client_id: TimerHandle}
+        self._tasks = set()  # keeps running batches referenced until done
+        self.batches = 0
+        self.messages = 0
+
+    async def infer(self, client_id, message):
+        """Returns the model's answer for one message, batched with its neighbours."""
+        if self.window <= 0 or self.max_size <= 1:
+            return (await self.pool.infer(client_id, [message]))[0]
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.setdefault(client_id, [])
+        batch.append((message, future))
+        if len(batch) >= self.max_size:
+            self._flush(client_id)
+        elif len(batch) == 1:
+            self._timers[client_id] = loop.call_later(self.window, self._flush, client_id)
+        return await future
+
+    def _flush(self, client_id):
+        timer = self._timers.pop(client_id, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(client_id, None)
+        if not batch:
+            return
+        task = asyncio.ensure_future(self._run(client_id, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, client_id, batch):
+        self.batches += 1
+        self.messages += len(batch)
+        try:
+            answers = await self.pool.infer(client_id, [message for message, _ in batch])
+        except Exception as e:
+            self._fail(batch, e)
+            return
+        if len(answers) != len(batch):
+            # zip() would leave the extra callers waiting forever
+            self._fail(batch, RuntimeError(f"model returned {len(answers)} answers for {len(batch)} messages"))
+            return
+        for (_, future), answer in zip(batch, answers):
+            # The caller may have gone away (client disconnect cancels its future)
+            if not future.done():
+                future.set_result(answer)
+
+    @staticmethod
+    def _fail(batch, error):
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "messages": self.messages,
+            "avg_batch_size": round(self.messages / self.batches, 2) if self.batches else 0,
+        }
+
+
+ai_batcher = MicroBatcher(inference_pool)
@@ -0,0 +1,85 @@
+# live_metrics.py
+# In-process publish/subscribe for live dashboards. analytics_writer reports
+# every committed batch; each open dashboard stream subscribes to its client
+# and receives per-client deltas on its own event loop, instead of every
+# dashboard re-running the analytics queries on a timer.
+import asyncio
+import os
+import threading
+from analytics_writer import analytics_writer
+
+# Deltas buffered per subscriber; a slow dashboard drops deltas and resyncs from the next snapshot
+LIVE_MAX_PENDING = int(os.getenv("LIVE_MAX_PENDING", "100"))
+
+
+def rows_delta(rows):
+    """{client_id: {"events": n, "event_types": {type: n}}} for analytics_row() tuples."""
+    deltas = {}
+    for client_id, _user_id, _source, event_type, _data, _details, _timestamp in rows:
+        delta = deltas.setdefault(int(client_id), {"events": 0, "event_types": {}})
+        delta["events"] += 1
+        types = delta["event_types"]
+        types[event_type] = types.get(event_type, 0) + 1
+    return deltas
+
+
+def merge_delta(into, delta):
+    into["events"] += delta["events"]
+    for event_type, n in delta["event_types"].items():
+        into["event_types"][event_type] = into["event_types"].get(event_type, 0) + n
+    return into
+
+
+class MetricsHub:
+    """client_id -> subscriber queues. publish_rows() is thread-safe; subscribe() runs on an event loop."""
+
+    def __init__(self, max_pending=LIVE_MAX_PENDING):
+        self.max_pending = max_pending
+        self._subscribers = {}  # {client_id: {queue: loop}}
+        self._lock = threading.Lock()
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, client_id):
+        q = asyncio.Queue(maxsize=self.max_pending)
+        with self._lock:
+            self._subscribers.setdefault(int(client_id), {})[q] = asyncio.get_running_loop()
+        return q
+
+    def unsubscribe(self, client_id, q):
+        with self._lock:
+            queues = self._subscribers.get(int(client_id))
+            if queues is not None:
+                queues.pop(q, None)
+                if not queues:
+                    del self._subscribers[int(client_id)]
+
+    def _deliver(self, q, delta):
+        try:
+            q.put_nowait(delta)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def publish_rows(self, rows):
+        if not self._subscribers:
+            return
+        for client_id, delta in rows_delta(rows).items():
+            with self._lock:
+                targets = list(self._subscribers.get(client_id, {}).items())
+            for q, loop in targets:
+                try:
+                    loop.call_soon_threadsafe(self._deliver, q, delta)
+                    self.published += 1
+                except RuntimeError:
+                    # The subscriber's loop has shut down
+                    self.unsubscribe(client_id, q)
+
+    def stats(self):
+        with self._lock:
+            subscribers = sum(len(queues) for queues in self._subscribers.values())
+            clients = len(self._subscribers)
+        return {"clients": clients, "subscribers": subscribers, "published": self.published, "dropped": self.dropped}
+
+
+metrics_hub = MetricsHub()
+analytics_writer.add_listener(metrics_hub.publish_rows)
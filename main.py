@@ -1,5 +1,6 @@
 from fastapi import FastAPI, Request, Form, HTTPException, status, Depends, Query, APIRouter
-from fastapi.responses import RedirectResponse, JSONResponse
+from contextlib import asynccontextmanager
+from fastapi.responses import RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from starlette.middleware.sessions import SessionMiddleware
@@ -8,7 +9,6 @@ from dotenv import load_dotenv
 import sqlite3
 import os
 import logging
-from rapidfuzz import process, fuzz
 from datetime import datetime
 import json
 from routes import welcome_message
@@ -25,7 +25,20 @@ from routes import analytics, faqs
 # CREATE APP
 # ----------------------------
 load_dotenv()
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Background only: the app is ready before any model is built
+    start_model_prewarm(inference_pool)
+    yield
+    inference_pool.shutdown()
+    analytics_writer.shutdown()
+    ai_quota.shutdown()
+    close_pools()
+
+
+app = FastAPI(lifespan=lifespan)
 
 router = APIRouter()
 
@@ -68,22 +81,37 @@ app.add_middleware(
 from db import (
     get_db,
     get_db_connection,
-    init_all_db,
+    get_pooled_db,
+    get_tenant_db,
+    tenant_conn,
+    fan_out,
+    pool_stats,
+    close_pools,
     read_faq,
     add_client,
-    is_client,
-    get_client_id,
     add_or_update_user_integration,
     delete_faq_in_db,
     log_audit,
-    get_faq_count
+    get_faq_count,
+    run_db,
+    is_client_async,
+    save_faq_async,
 )
-from models_utils import load_client_model  # client-specific AI model loader
+from models_utils import get_model_version, model_cache, start_model_prewarm  # client-specific AI model loader
+import models_utils
+from faq_matcher import get_matcher_async, faq_saved, faq_deleted
+from reply_cache import reply_cache
+from inference import inference_pool, ai_batcher
+from chatbot_batch import reply_batch_async, CHATBOT_BATCH_MAX_MESSAGES, EMPTY_MESSAGE_REPLY
+from analytics_writer import analytics_writer
+from identity import Identity, resolve_identity, optional_client, require_client, invalidate_identity, identity_cache
+from quota import ai_quota, QUOTA_EXCEEDED_REPLY
+from live_metrics import metrics_hub
 
 # ----------------------------
 # CLIENT MODEL CACHE
 # ----------------------------
-client_models = {}  # {client_id: model_instance}
+client_models = model_cache  # LRU of built models, bounded by MODEL_CACHE_MAX_MB (per process)
 
 
 # ----------------------------
@@ -115,9 +143,8 @@ app.add_middleware(
     https_only=os.getenv("ENV") == "production"
 )
 
-# Database
+# Database (db.py migrates the schema on import)
 DB_FILE = os.getenv("DB_FILE", r"D:\ai-support-bot\ai-support-bot.db")
-init_all_db()
 
 # Logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
@@ -153,12 +180,13 @@ async def auth_google_callback(request: Request):
         if not email:
             raise HTTPException(status_code=400, detail="Google login failed: no email returned")
 
-        if not is_client(email):
-            add_client(email, name, picture)
+        if not await is_client_async(email):
+            await run_db(add_client, email, name, picture)
 
         request.session["user"] = {"email": email, "name": name, "picture": picture}
-        client_id = get_client_id(email)
-        request.session["client_id"] = client_id
+        request.session.pop("identity", None)
+        identity = await resolve_identity(request)
+        request.session["client_id"] = identity.client_id if identity else None
 
         return RedirectResponse(url="/dashboard")
     except Exception as e:
@@ -169,61 +197,57 @@ async def auth_google_callback(request: Request):
 # DASHBOARD
 # ----------------------------
 @app.get("/dashboard")
-def dashboard(request: Request, conn: sqlite3.Connection = Depends(get_db)):
-    user = request.session.get("user")
-    if not user or not is_client(user.get("email")):
-        request.session.pop("user", None)
-        return RedirectResponse(url="/login")
-
-    client_id = get_client_id(user["email"])
-    if not client_id:
+def dashboard(request: Request, identity: Identity = Depends(optional_client),
+              conn: sqlite3.Connection = Depends(get_pooled_db)):
+    if identity is None:
         request.session.pop("user", None)
         return RedirectResponse(url="/login")
 
-    faq = read_faq(client_id)
+    user = request.session["user"]
+    client_id = identity.client_id
+    faq = read_faq(client_id, conn=tenant_conn(client_id, conn))
     row = conn.execute("SELECT integration_code FROM client_integrations WHERE client_id=?", (client_id,)).fetchone()
     integration_code = row["integration_code"] if row and row["integration_code"] else "<script src='/static/script.js'></script>"
     if not row:
-        add_or_update_user_integration(user["email"], integration_code, conn)
+        add_or_update_user_integration(user["email"], integration_code, conn, client_id=client_id)
 
     display_name = user.get("name") or user["email"].split("@")[0]
     display_picture = user.get("picture") or "/static/default_avatar.png"
 
-return templates.TemplateResponse(
-    "index.html",
-    {
-        "request": request,
-        "user": {
-            "name": display_name,
-            "email": user["email"],
-            "picture": display_picture,
-            "client_id": client_id
-        },
-        "faq": faq
-    }
-)
+    return templates.TemplateResponse(
+        "index.html",
+        {
+            "request": request,
+            "user": {
+                "name": display_name,
+                "email": user["email"],
+                "picture": display_picture,
+                "client_id": client_id
+            },
+            "faq": faq
+        }
+    )
 
 
 # ----------------------------
 # FAQ / Welcome Message
 # ----------------------------
+def _read_all_faqs():
+    rows = fan_out("SELECT question, answer, popular FROM faqs ORDER BY popular DESC, id ASC")
+    # Popular first across shards too (sorted() is stable, so per-shard order is kept)
+    rows = sorted(rows, key=lambda row: not row["popular"])
+    return {row["question"]: {"answer": row["answer"], "popular": bool(row["popular"])} for row in rows}
+
 @app.get("/faq_data")
 async def faq_data():
-    conn = get_db_connection()
-    cursor = conn.execute("SELECT question, answer, popular FROM faqs ORDER BY popular DESC, id ASC")
-    faqs = {row["question"]: {"answer": row["answer"], "popular": bool(row["popular"])} for row in cursor.fetchall()}
+    faqs = await run_db(_read_all_faqs)
     popular_faqs = {q: faqs[q] for q in faqs if faqs[q]["popular"]}
-    conn.close()
     return {"all": faqs, "popular": popular_faqs}
 
 @app.post("/update_faq")
-async def update_faq(request: Request):
-    user = request.session.get("user")
-    if not user or not is_client(user.get("email")):
-        raise HTTPException(status_code=403, detail="Unauthorized")
-
+async def update_faq(request: Request, identity: Identity = Depends(require_client)):
     data = await request.json()
-    client_id = get_client_id(user["email"])
+    client_id = identity.client_id
     question = str(data.get("question", "")).strip()
     answer = str(data.get("answer", "")).strip()
     popular = int(data.get("popular", 0))
@@ -231,49 +255,30 @@ async def update_faq(request: Request):
     if not question or not answer:
         raise HTTPException(status_code=400, detail="Missing required fields")
 
-    conn = sqlite3.connect(DB_FILE, timeout=30, detect_types=sqlite3.PARSE_DECLTYPES)
-    conn.row_factory = sqlite3.Row
-    try:
-        with conn:
-            conn.execute("""
-                INSERT INTO faqs (client_id, question, answer, popular)
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT(client_id, question) DO UPDATE SET
-                    answer=excluded.answer,
-                    popular=excluded.popular
-            """, (client_id, question, answer, popular))
-    finally:
-        conn.close()
+    await save_faq_async(client_id, question, answer, popular)
+    faq_saved(client_id, question, answer)
 
     return {"success": True, "message": "FAQ saved successfully"}
 
 
 @app.post("/delete_faq")
-def delete_faq(request: Request, question: str = Form(...)):
-    user = request.session.get("user")
-    if not user or not is_client(user.get("email")):
-        raise HTTPException(status_code=403, detail="Unauthorized")
-    delete_faq_in_db(get_client_id(user["email"]), question)
+def delete_faq(question: str = Form(...), identity: Identity = Depends(require_client)):
+    client_id = identity.client_id
+    delete_faq_in_db(client_id, question)
+    faq_deleted(client_id, question)
     return {"success": True}
 
 @app.get("/welcome_message")
-def get_welcome_message(request: Request):
-    user = request.session.get("user")
-    if not user or not is_client(user.get("email")):
-        raise HTTPException(status_code=403, detail="Unauthorized")
-    conn = get_db_connection()
-    client_id = get_client_id(user["email"], conn)
-    row = conn.execute("SELECT message FROM welcome_messages WHERE client_id=?", (client_id,)).fetchone()
+def get_welcome_message(identity: Identity = Depends(require_client)):
+    conn = get_tenant_db(identity.client_id)
+    row = conn.execute("SELECT message FROM welcome_messages WHERE client_id=?", (identity.client_id,)).fetchone()
     conn.close()
     return {"message": row["message"] if row else "Hello! How can I assist you today?"}
 
 @app.post("/update_welcome_message")
-def update_welcome_message(request: Request, message: str = Form(...)):
-    user = request.session.get("user")
-    if not user or not is_client(user.get("email")):
-        raise HTTPException(status_code=403, detail="Unauthorized")
-    conn = get_db_connection()
-    client_id = get_client_id(user["email"], conn)
+def update_welcome_message(message: str = Form(...), identity: Identity = Depends(require_client)):
+    client_id = identity.client_id
+    conn = get_tenant_db(client_id)
     existing = conn.execute("SELECT id FROM welcome_messages WHERE client_id=?", (client_id,)).fetchone()
     if existing:
         conn.execute("UPDATE welcome_messages SET message=? WHERE id=?", (message, existing["id"]))
@@ -283,81 +288,162 @@ def update_welcome_message(request: Request, message: str = Form(...)):
         action = "Added welcome message"
     conn.commit()
     conn.close()
-    log_audit(client_id, action, performed_by=user["email"])
+    log_audit(client_id, action, performed_by=identity.email)
     return {"success": True}
 
 @app.post("/update_integration")
-def update_integration(request: Request, code: str = Form(...)):
-    user = request.session.get("user")
-    if not user or not is_client(user.get("email")):
-        raise HTTPException(status_code=403, detail="Unauthorized")
-    add_or_update_user_integration(user["email"], code)
+def update_integration(code: str = Form(...), identity: Identity = Depends(require_client)):
+    add_or_update_user_integration(identity.email, code, client_id=identity.client_id)
     return {"success": True, "message": "Integration code saved."}
 
 # ----------------------------
 # Chatbot (FAQ + AI)
 # ----------------------------
-MAX_FAQ_MATCH_SCORE = 65
-
 def log_analytics_event(client_id, event_type, details="", user_id=None, source="customer"):
-    conn = get_db_connection()
-    ts = datetime.utcnow().isoformat()
+    # Queued and group-committed by the analytics writer thread
+    analytics_writer.log(client_id, event_type, details, user_id=user_id, source=source)
+
+async def log_analytics_event_async(client_id, event_type, details="", user_id=None, source="customer"):
+    await analytics_writer.log_async(client_id, event_type, details, user_id=user_id, source=source)
+
+async def _quick_reply(client_id, user_msg):
+    """
+    Resolves a message from the reply cache or the FAQ matcher, without the model.
+    Returns (cache_version, reply) where reply is (bot_reply, source, matched_question, cached) or None.
+    """
+    matcher = await get_matcher_async(client_id)
+    cache_version = (matcher.version, get_model_version(client_id))
+
+    # Repeated question: skip matching and inference entirely
+    cached = reply_cache.get(client_id, user_msg, cache_version)
+    if cached:
+        return cache_version, (*cached, True)
+
+    # FAQ fuzzy match (corpus is cached in memory per client)
+    best_match = matcher.match(user_msg)
+    if best_match:
+        return cache_version, (best_match[1], "faq", best_match[0], False)
+    return cache_version, None
+
+
+async def _ai_allowed(identity):
+    """Counts the request against the monthly AI allowance; False when it is used up."""
+    return await ai_quota.acquire_async(identity.client_id, identity.plan)
+
+
+async def _ai_reply(client_id, user_msg):
+    """Returns (bot_reply, source) from the client's model, or an error reply. Call _ai_allowed first."""
     try:
-        conn.execute("""
-            INSERT INTO analytics (client_id, user_id, event_type, details, timestamp, source)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (client_id, user_id, event_type, json.dumps(details), ts, source))
-        conn.commit()
-    finally:
-        conn.close()
+        # Batched with concurrent messages for this client, then run in
+        # the inference worker that owns its model
+        return await ai_batcher.infer(client_id, user_msg), "ai"
+    except Exception as e:
+        ai_quota.release(client_id)
+        return f"Error processing message: {str(e)}", "error"
+
+
+async def _record_reply(client_id, email, user_msg, cache_version, bot_reply, source, matched_question, cached):
+    """Logs the chatbot analytics event and caches fresh, successful replies."""
+    details = {"message": user_msg, "cached": cached}
+    if matched_question:
+        details["matched_question"] = matched_question
+    await log_analytics_event_async(client_id, f"chatbot_{source}", details, user_id=email)
+
+    if not cached and source in ("faq", "ai"):
+        reply_cache.put(client_id, user_msg, cache_version, (bot_reply, source, matched_question))
+
 
 @app.post("/chatbot_message")
-async def chatbot_message(request: Request):
+async def chatbot_message(request: Request, identity: Identity = Depends(optional_client)):
     data = await request.json()
     user_msg = data.get("message", "").strip()
     if not user_msg:
-        return JSONResponse({"reply": "Please type a message."})
+        return JSONResponse({"reply": EMPTY_MESSAGE_REPLY})
 
-    user = request.session.get("user")
-    if not user or not is_client(user.get("email")):
+    if identity is None:
         raise HTTPException(status_code=403, detail="Unauthorized")
-    client_id = get_client_id(user["email"])
+    client_id = identity.client_id
+
+    cache_version, reply = await _quick_reply(client_id, user_msg)
+    if reply:
+        bot_reply, source, matched_question, cached = reply
+    elif await _ai_allowed(identity):
+        # AI fallback
+        bot_reply, source = await _ai_reply(client_id, user_msg)
+        matched_question, cached = None, False
+    else:
+        # Over quota: answered without loading or queueing for the model
+        bot_reply, source, matched_question, cached = QUOTA_EXCEEDED_REPLY, "quota", None, False
 
-    # Load FAQs
-    conn = get_db_connection()
-    cursor = conn.execute("SELECT question, answer FROM faqs WHERE client_id=?", (client_id,))
-    faqs = {row["question"]: row["answer"] for row in cursor.fetchall()}
-    conn.close()
+    await _record_reply(client_id, identity.email, user_msg, cache_version, bot_reply, source, matched_question, cached)
+    return JSONResponse({"reply": bot_reply, "source": source})
 
-    bot_reply = None
-    source = None
-
-    # FAQ fuzzy match
-    if faqs:
-        best_match = process.extractOne(user_msg, list(faqs.keys()), scorer=fuzz.token_sort_ratio)
-        if best_match and best_match[1] < MAX_FAQ_MATCH_SCORE:
-            best_match = process.extractOne(user_msg, list(faqs.keys()), scorer=fuzz.partial_ratio)
-        if best_match and best_match[1] >= MAX_FAQ_MATCH_SCORE:
-            bot_reply = faqs[best_match[0]]
-            source = "faq"
-
-    # AI fallback
-    if not bot_reply:
-        try:
-            model = load_client_model(client_id)
-            bot_reply = model([user_msg])[0]
-            source = "ai"
-        except Exception as e:
-            bot_reply = f"Error processing message: {str(e)}"
-            source = "error"
-
-    # Log analytics
-    details = {"message": user_msg}
-    if source == "faq":
-        details["matched_question"] = best_match[0]
-    log_analytics_event(client_id, f"chatbot_{source}", details, user_id=user.get("email"))
 
-    return JSONResponse({"reply": bot_reply, "source": source})
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/chatbot_message/stream")
+async def chatbot_message_stream(request: Request, identity: Identity = Depends(optional_client)):
+    """
+    Server-sent events variant of /chatbot_message.
+    Emits 'meta' as soon as the source is known, the reply as one or more 'delta'
+    events, then 'done' with the full reply. Analytics are logged once, at the end.
+    """
+    data = await request.json()
+    user_msg = data.get("message", "").strip()
+
+    if user_msg and identity is None:
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    client_id = identity.client_id if user_msg else None
+
+    async def events():
+        if not user_msg:
+            yield _sse("delta", {"text": EMPTY_MESSAGE_REPLY})
+            yield _sse("done", {"reply": EMPTY_MESSAGE_REPLY, "source": None})
+            return
+
+        cache_version, reply = await _quick_reply(client_id, user_msg)
+        if reply:
+            # FAQ/cached answers are sent immediately, in one piece
+            bot_reply, source, matched_question, cached = reply
+            yield _sse("meta", {"source": source})
+            yield _sse("delta", {"text": bot_reply})
+        elif not await _ai_allowed(identity):
+            bot_reply, source, matched_question, cached = QUOTA_EXCEEDED_REPLY, "quota", None, False
+            yield _sse("meta", {"source": source})
+            yield _sse("delta", {"text": bot_reply})
+        else:
+            # First byte goes out before inference starts
+            yield _sse("meta", {"source": "ai"})
+            bot_reply, source = await _ai_reply(client_id, user_msg)
+            matched_question, cached = None, False
+            # DeepPavlov returns whole answers; send them word by word so the
+            # widget can render as it reads
+            for i, word in enumerate(str(bot_reply).split(" ")):
+                yield _sse("delta", {"text": word if i == 0 else " " + word})
+
+        await _record_reply(client_id, identity.email, user_msg, cache_version, bot_reply, source, matched_question, cached)
+        yield _sse("done", {"reply": bot_reply, "source": source})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.post("/chatbot_batch")
+async def chatbot_batch(request: Request, identity: Identity = Depends(require_client)):
+    """
+    Replies to a list of messages in one call, for replay and evaluation.
+    Returns reply, source, matched_question and score per message; no analytics are logged,
+    but model replies count against the monthly AI quota.
+    """
+    data = await request.json()
+    messages = data.get("messages")
+    if not isinstance(messages, list) or not messages:
+        raise HTTPException(status_code=400, detail="messages must be a non-empty list")
+    if len(messages) > CHATBOT_BATCH_MAX_MESSAGES:
+        raise HTTPException(status_code=400, detail=f"At most {CHATBOT_BATCH_MAX_MESSAGES} messages per batch")
+
+    results = await reply_batch_async(identity.client_id, [str(m).strip() for m in messages], plan=identity.plan)
+    return {"results": results}
 
 # ----------------------------
 # Landing & Index
@@ -367,9 +453,9 @@ def landing(request: Request):
     return templates.TemplateResponse("landing.html", {"request": request})
 
 @app.get("/")
-def index(request: Request):
+def index(request: Request, identity: Identity = Depends(optional_client)):
     user = request.session.get("user")
-    faq = read_faq(get_client_id(user["email"])) if user else read_faq()
+    faq = read_faq(identity.client_id) if identity else read_faq()
     popular_questions = [q for q, i in faq.items() if i.get("popular")]
     return templates.TemplateResponse(
         "index.html",
@@ -379,15 +465,20 @@ def index(request: Request):
 # ----------------------------
 # Profile & Logout
 # ----------------------------
+def _update_client_profile(current_email, name, email, company, role):
+    with get_db_connection() as conn:
+        conn.execute("UPDATE clients SET name=?, email=?, company=?, role=? WHERE lower(email)=lower(?)",
+                     (name, email, company, role, current_email))
+
 @app.post("/update_profile")
 async def update_profile(request: Request, name: str = Form(...), email: str = Form(...), company: str = Form(""), role: str = Form("")):
     user = request.session.get("user")
     if not user:
         return RedirectResponse(url="/login")
-    conn = get_db_connection()
-    conn.execute("UPDATE clients SET name=?, email=?, company=?, role=? WHERE email=?", (name, email, company, role, user["email"]))
-    conn.commit()
-    conn.close()
+    await run_db(_update_client_profile, user["email"], name, email, company, role)
+    invalidate_identity(user["email"])
+    invalidate_identity(email)
+    request.session.pop("identity", None)
     request.session["user"].update({"name": name, "email": email, "company": company, "role": role})
     return RedirectResponse(url="/dashboard", status_code=303)
 
@@ -418,11 +509,28 @@ def admin_page(request: Request):
     faq = read_faq()
     return templates.TemplateResponse("admin.html", {"request": request, "faq": faq})
 
+@app.get("/admin/model_cache")
+def admin_model_cache(request: Request):
+    if not request.session.get("admin_logged_in"):
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    return {
+        **client_models.stats(),
+        "workers": inference_pool.stats(),
+        "batching": ai_batcher.stats(),
+        "prewarm": models_utils.last_prewarm_report,
+    }
+
+@app.get("/admin/db_pool")
+def admin_db_pool(request: Request):
+    if not request.session.get("admin_logged_in"):
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    return {"pools": pool_stats(), "identity_cache": identity_cache.stats(), "analytics_writer": analytics_writer.stats(),
+            "ai_quota": ai_quota.stats(), "live_metrics": metrics_hub.stats()}
+
 @app.get("/logout")
-def admin_logout(request: Request):
-    user_email = request.session.get("user", {}).get("email")
-    if user_email:
-        log_audit(get_client_id(user_email), "Client logged out", performed_by=user_email)
+def admin_logout(request: Request, identity: Identity = Depends(optional_client)):
+    if identity:
+        log_audit(identity.client_id, "Client logged out", performed_by=identity.email)
     request.session.clear()
     return RedirectResponse(url="/admin_login")
 
@@ -434,19 +542,15 @@ def login(request: Request):
 # Analytics Logging Endpoint
 # ----------------------------
 @app.post("/analytics/log_event")
-async def log_event(request: Request):
-    user = request.session.get("user")
-    if not user or not is_client(user.get("email")):
-        raise HTTPException(status_code=403, detail="Unauthorized")
-
+async def log_event(request: Request, identity: Identity = Depends(require_client)):
     data = await request.json()
     event_type = data.get("event_type")
     details = data.get("details", "")
     if not event_type:
         raise HTTPException(status_code=400, detail="Missing event_type")
 
-    client_id = get_client_id(user["email"])
-    log_analytics_event(client_id, event_type, details, user_id=user.get("email"))
+    client_id = identity.client_id
+    await log_analytics_event_async(client_id, event_type, details, user_id=identity.email)
     return {"success": True, "message": f"Logged event '{event_type}' for client {client_id}"}
 
 # ----------------------------
@@ -1,15 +1,214 @@
 import os
 import shutil
+import threading
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from deeppavlov import build_model
 
 BASE_MODEL_DIR = os.path.join(os.getcwd(), "models")
 TEMPLATE_MODEL_DIR = os.path.join(BASE_MODEL_DIR, "faq_template")  # Pre-trained template
 
+# Bumped whenever a client's model files change; part of the reply cache version
+_model_versions = {}  # {client_id: int}
 
-def create_client_model(client_id):
+
+def get_model_version(client_id):
+    return _model_versions.get(int(client_id), 0)
+
+
+def bump_model_version(client_id):
+    _model_versions[int(client_id)] = get_model_version(client_id) + 1
+
+
+# ======================
+# LOADED MODEL CACHE
+# ======================
+# Memory budget for built models, shared by all tenants in this process
+MODEL_CACHE_MAX_MB = int(os.getenv("MODEL_CACHE_MAX_MB", "2048"))
+# Floor for a model's estimated size: configs often reference weights outside the model dir
+MODEL_MIN_SIZE_MB = int(os.getenv("MODEL_MIN_SIZE_MB", "100"))
+
+
+def estimate_model_size(model_path):
+    """Rough in-memory size of a built model in bytes, from the size of its files on disk."""
+    total = 0
+    for root, _, files in os.walk(model_path, followlinks=True):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return max(total, MODEL_MIN_SIZE_MB * 1024 * 1024)
+
+
+class ModelCache:
+    """
+    LRU cache of built models bounded by an estimated memory budget.
+    Each key has its own lock, so concurrent cold requests for the same
+    model trigger a single build while other tenants keep being served.
+    """
+
+    def __init__(self, max_bytes=MODEL_CACHE_MAX_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # {key: (model, size)}
+        self._key_locks = {}
+        self._pinned = set()  # never evicted by the LRU (e.g. the shared base model)
+        self._lock = threading.Lock()
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def get_or_load(self, key, loader):
+        """Returns the cached model for key, or builds it with loader() -> (model, size_bytes)."""
+        model = self._lookup(key)
+        if model is not None:
+            return model
+
+        with self._key_lock(key):
+            # Another request may have built it while we waited
+            model = self._lookup(key)
+            if model is not None:
+                return model
+            with self._lock:
+                self.misses += 1
+            model, size = loader()
+            self.put(key, model, size)
+            return model
+
+    def put(self, key, model, size):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.used_bytes -= old[1]
+            self._entries[key] = (model, size)
+            self.used_bytes += size
+            # Always keep the newest model, even if it alone exceeds the budget
+            evictable = [k for k in self._entries if k != key and k not in self._pinned]
+            for old_key in evictable:
+                if self.used_bytes <= self.max_bytes:
+                    break
+                _, evicted_size = self._entries.pop(old_key)
+                self.used_bytes -= evicted_size
+                self.evictions += 1
+
+    def pin(self, key):
+        with self._lock:
+            self._pinned.add(key)
+
+    def evict(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.used_bytes -= entry[1]
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def keys(self):
+        with self._lock:
+            return set(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "models": len(self._entries),
+                "used_mb": round(self.used_bytes / (1024 * 1024), 1),
+                "max_mb": round(self.max_bytes / (1024 * 1024), 1),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+model_cache = ModelCache()
+
+
+# Files every client gets its own copy of; everything else links to the template
+CLIENT_OWNED_FILES = {"config.json"}
+# Cache key of the template model, shared by every client that has not diverged from it
+TEMPLATE_CACHE_KEY = ("template", 0)
+
+
+def _link_or_copy(src, dst):
+    """Hardlink src to dst, falling back to a symlink, then to a real copy."""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        os.symlink(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def link_template(model_path):
+    """
+    Lays out a client model directory over the shared template: template files are
+    hardlinked (or symlinked), and only CLIENT_OWNED_FILES are materialized.
+    Anything that writes per-client artifacts (e.g. fine-tuned deltas) must replace
+    files rather than modify them in place, or it would write through to the template.
     """
-    Creates a folder for the client's FAQ model by copying the template.
-    Saves the path in client_models table.
+    for root, _, files in os.walk(TEMPLATE_MODEL_DIR):
+        rel_root = os.path.relpath(root, TEMPLATE_MODEL_DIR)
+        target_root = os.path.normpath(os.path.join(model_path, rel_root))
+        os.makedirs(target_root, exist_ok=True)
+        for name in files:
+            src = os.path.join(root, name)
+            dst = os.path.join(target_root, name)
+            rel = os.path.normpath(os.path.join(rel_root, name))
+            if rel in CLIENT_OWNED_FILES:
+                shutil.copy2(src, dst)
+            else:
+                _link_or_copy(src, dst)
+
+
+def uses_shared_template(model_path):
+    """
+    True if a client model directory is still identical to the template: every file is
+    a link to its template counterpart or an unchanged copy of a client-owned file.
+    Such clients are served by the shared template model instead of their own build.
+    """
+    if not os.path.isdir(TEMPLATE_MODEL_DIR) or not os.path.isdir(model_path):
+        return False
+    for root, _, files in os.walk(model_path):
+        for name in files:
+            rel = os.path.relpath(os.path.join(root, name), model_path)
+            template_file = os.path.join(TEMPLATE_MODEL_DIR, rel)
+            client_file = os.path.join(model_path, rel)
+            if not os.path.exists(template_file):
+                return False
+            if os.path.samefile(client_file, template_file):
+                continue
+            if os.path.normpath(rel) not in CLIENT_OWNED_FILES:
+                return False
+            with open(client_file, "rb") as a, open(template_file, "rb") as b:
+                if a.read() != b.read():
+                    return False
+    return True
+
+
+def create_client_model(client_id, conn=None):
+    """
+    Creates a folder for the client's FAQ model that links to the template's artifacts.
+    Saves the path in client_models table, on conn if the caller already holds a catalog connection.
     """
     from db import get_db_connection  # moved import here to avoid circular import
 
@@ -19,10 +218,12 @@ def create_client_model(client_id):
     os.makedirs(client_model_path, exist_ok=True)
 
     if os.path.exists(TEMPLATE_MODEL_DIR):
-        shutil.copytree(TEMPLATE_MODEL_DIR, client_model_path, dirs_exist_ok=True)
+        link_template(client_model_path)
 
     # Save path in DB
-    conn = get_db_connection()
+    close_conn = conn is None
+    if close_conn:
+        conn = get_db_connection()
     try:
         conn.execute("""
             INSERT INTO client_models (client_id, model_path)
@@ -31,16 +232,29 @@ def create_client_model(client_id):
         """, (client_id, client_model_path))
         conn.commit()
     finally:
-        conn.close()
+        if close_conn:
+            conn.close()
 
+    old_key = model_cache_key(client_id)
+    model_cache.evict(old_key)
+    _model_sources.pop(old_key, None)
+    bump_model_version(client_id)
     return client_model_path
 
 
-def load_client_model(client_id):
-    """
-    Loads a client-specific DeepPavlov model.
-    If no model exists yet, creates one automatically.
-    """
+def model_cache_key(client_id, model_version=None):
+    """Cache key for a client's model; a new model version never hits an old entry."""
+    if model_version is None:
+        model_version = get_model_version(client_id)
+    return int(client_id), model_version
+
+
+# {client cache key: (cache key of the model serving it, model_path)}
+_model_sources = {}
+
+
+def get_client_model_path(client_id):
+    """Returns the client's model directory, creating it from the template if missing."""
     from db import get_db_connection  # moved import here to avoid circular import
 
     conn = get_db_connection()
@@ -49,13 +263,263 @@ def load_client_model(client_id):
 
     if not row:
         # Auto-create model if missing
-        model_path = create_client_model(client_id)
-    else:
-        model_path = row["model_path"]
+        return create_client_model(client_id)
+    return row["model_path"]
+
+
+def load_client_model(client_id, model_version=None):
+    """
+    Returns the client-specific DeepPavlov model, building it on first use.
+    Clients whose model directory still matches the template share one built
+    template model. Built models are kept in model_cache; see build_client_model
+    for the uncached path. Inference workers pass the parent process's model_version.
+    In MODEL_MODE=shared, clients with a head get a TenantModelView over the shared base instead.
+    """
+    cache_key, model_path = _model_source(client_id, model_version)
+    if is_head_key(cache_key):
+        return load_tenant_view(client_id, cache_key, model_path)
+    return model_cache.get_or_load(cache_key, lambda: _build_from_path(model_path))
+
+
+def _model_source(client_id, model_version=None):
+    """(cache key, directory it is built from) of the model serving the client, remembered per model version."""
+    client_key = model_cache_key(client_id, model_version)
+    source = _model_sources.get(client_key)
+    if source is None:
+        source = _model_sources[client_key] = resolve_model_source(client_key, get_client_model_path(client_id))
+        if MODEL_MODE == "shared" and source[0] == client_key:
+            logging.info("Client %s has no %s but a customized model; serving its own build instead of the shared base",
+                         client_id, HEAD_CONFIG_FILE)
+    return source
 
+
+def resolve_model_source(client_key, model_path):
+    """
+    Which cached model serves a client with this model directory: in MODEL_MODE=shared its
+    head if it has one; otherwise the shared template if the directory still matches it,
+    else the client's own build.
+    """
+    if MODEL_MODE == "shared" and os.path.exists(os.path.join(model_path, HEAD_CONFIG_FILE)):
+        return (*client_key, "head"), model_path
+    if uses_shared_template(model_path):
+        return TEMPLATE_CACHE_KEY, TEMPLATE_MODEL_DIR
+    return client_key, model_path
+
+
+def is_head_key(cache_key):
+    return cache_key[-1] == "head"
+
+
+def build_client_model(client_id):
+    """
+    Builds a client-specific DeepPavlov model and returns (model, estimated_size_bytes).
+    If no model exists yet, creates one automatically.
+    """
+    return _build_from_path(get_client_model_path(client_id))
+
+
+def _build_from_path(model_path):
     config_file = os.path.join(model_path, "config.json")
     if not os.path.exists(config_file):
         raise FileNotFoundError(f"Config file not found at {config_file}")
 
     model = build_model(config_file, download=False)
-    return model
+    return model, estimate_model_size(model_path)
+
+
+# ======================
+# SHARED BASE + TENANT HEADS
+# ======================
+# "tenant": every client builds its own model from its config.json (default).
+# "shared": one base model (the template) per process; a client with a head
+# (HEAD_CONFIG_FILE in its model directory) runs the base up to the features its
+# head takes, then its head. Clients without a head are served as in "tenant" mode.
+MODEL_MODE = os.getenv("MODEL_MODE", "tenant")
+HEAD_CONFIG_FILE = "head_config.json"
+# Heads are small, so they get a much lower size floor than full models
+MODEL_HEAD_MIN_SIZE_MB = int(os.getenv("MODEL_HEAD_MIN_SIZE_MB", "1"))
+
+
+class TenantModelView:
+    """
+    Thin per-tenant model over the shared base. Called like a DeepPavlov model:
+    the base pipeline only computes the variables the head's chainer takes as
+    input (its encoder features; Chainer.compute skips the components after
+    them), and the head turns those into the tenant's answers.
+    """
+
+    def __init__(self, client_id, base, head):
+        self.client_id = client_id
+        self.base = base
+        self.head = head
+        self.features = list(head.in_x)
+
+    def __call__(self, batch):
+        features = self.base.compute(list(batch), targets=self.features)
+        if len(self.features) == 1:
+            return self.head(features)
+        return self.head(*features)
+
+
+def load_base_model():
+    """Returns the shared base model, built once per process and never evicted."""
+    model_cache.pin(TEMPLATE_CACHE_KEY)
+    return model_cache.get_or_load(TEMPLATE_CACHE_KEY, lambda: _build_from_path(TEMPLATE_MODEL_DIR))
+
+
+def load_tenant_view(client_id, head_key, model_path):
+    head = model_cache.get_or_load(head_key, lambda: _build_head(model_path))
+    return TenantModelView(client_id, load_base_model(), head)
+
+
+def _build_head(model_path):
+    model = build_model(os.path.join(model_path, HEAD_CONFIG_FILE), download=False)
+    return model, estimate_head_size(model_path)
+
+
+def estimate_head_size(model_path):
+    """Like estimate_model_size, but linked template files belong to the base; only the tenant's own files count."""
+    size = 0
+    for root, _, files in os.walk(model_path):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.islink(path) or os.stat(path).st_nlink > 1:
+                continue
+            size += os.path.getsize(path)
+    return max(size, MODEL_HEAD_MIN_SIZE_MB * 1024 * 1024)
+
+
+# ======================
+# MODEL PREWARMING
+# ======================
+MODEL_PREWARM_DAYS = int(os.getenv("MODEL_PREWARM_DAYS", "7"))
+# Budget for prewarmed models per serving process (each inference worker has its own cache); 0 disables prewarming
+MODEL_PREWARM_MAX_MB = int(os.getenv("MODEL_PREWARM_MAX_MB", str(MODEL_CACHE_MAX_MB // 2)))
+
+last_prewarm_report = {}
+
+
+class LocalModels:
+    """
+    The processes prewarm_models can warm, as seen by it: here, only this
+    process's model_cache. inference.InferencePool has the same three methods
+    for its worker processes.
+    """
+
+    def worker_index(self, client_id):
+        return 0
+
+    def loaded_keys(self, client_id):
+        return model_cache.keys()
+
+    def warm(self, client_id):
+        load_client_model(client_id)
+
+
+local_models = LocalModels()
+
+
+def rank_recent_ai_clients(days=MODEL_PREWARM_DAYS):
+    """Returns [(client_id, ai_messages, model_path)] for clients with recent AI fallbacks, busiest first."""
+    from db import get_db_connection, fan_out_analytics  # moved import here to avoid circular import
+
+    since = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    # analytics may be spread over tenant shards and client_models lives in the
+    # catalog, so count per shard (and per month partition in range) and join in Python
+    counts = {}
+    for row in fan_out_analytics("""
+        SELECT client_id, COUNT(*) AS ai_messages
+        FROM {table}
+        WHERE event_type='chatbot_ai' AND timestamp >= ?
+        GROUP BY client_id
+    """, (since,), start=since):
+        client_id = int(row["client_id"])
+        counts[client_id] = counts.get(client_id, 0) + row["ai_messages"]
+
+    conn = get_db_connection()
+    try:
+        paths = {r["client_id"]: r["model_path"]
+                 for r in conn.execute("SELECT client_id, model_path FROM client_models").fetchall()}
+    finally:
+        conn.close()
+    ranked = sorted(((cid, n, paths[cid]) for cid, n in counts.items() if cid in paths),
+                    key=lambda item: item[1], reverse=True)
+    return ranked
+
+
+def prewarm_models(days=MODEL_PREWARM_DAYS, max_mb=MODEL_PREWARM_MAX_MB, models=local_models):
+    """
+    Loads the models of the busiest recent AI tenants until max_mb of estimated
+    model memory is used in each serving process. models is local_models (this
+    process) or the inference pool; what each process already holds is asked
+    from that process, and a tenant costs only the models it still needs there
+    (nothing for a template already loaded, only its head size if it has one).
+    Returns a report of what was warmed.
+    """
+    global last_prewarm_report
+    started = datetime.utcnow()
+    budget = max_mb * 1024 * 1024
+    used = {}    # {worker index: bytes warmed}
+    loaded = {}  # {worker index: cache keys loaded there}
+    warmed, skipped, failed = [], [], []
+
+    for client_id, ai_messages, model_path in rank_recent_ai_clients(days):
+        worker = models.worker_index(client_id)
+        if worker not in loaded:
+            try:
+                loaded[worker] = set(models.loaded_keys(client_id))
+            except Exception as e:
+                logging.warning("Model prewarm: cannot read worker %s's loaded models: %s", worker, e)
+                loaded[worker] = set()
+
+        cache_key, build_path = resolve_model_source(model_cache_key(client_id), model_path)
+        needed = {cache_key: build_path}
+        if is_head_key(cache_key):
+            needed[TEMPLATE_CACHE_KEY] = TEMPLATE_MODEL_DIR  # the base the view runs on
+        missing = {key: path for key, path in needed.items() if key not in loaded[worker]}
+        if not missing:
+            skipped.append({"client_id": client_id, "reason": "already loaded"})
+            continue
+
+        # Heads only cost their own files; the template is counted once per worker
+        size = sum(estimate_head_size(path) if is_head_key(key) else estimate_model_size(path)
+                   for key, path in missing.items())
+        if used.get(worker, 0) + size > budget:
+            skipped.append({"client_id": client_id, "reason": "over budget"})
+            continue
+        try:
+            models.warm(client_id)
+        except Exception as e:
+            failed.append({"client_id": client_id, "error": str(e)})
+            continue
+        used[worker] = used.get(worker, 0) + size
+        loaded[worker].update(missing)
+        warmed.append({"client_id": client_id, "worker": worker, "ai_messages": ai_messages,
+                       "size_mb": round(size / (1024 * 1024), 1)})
+
+    last_prewarm_report = {
+        "started_at": started.isoformat(),
+        "seconds": round((datetime.utcnow() - started).total_seconds(), 2),
+        "warmed": warmed,
+        "skipped": skipped,
+        "failed": failed,
+    }
+    logging.info("Model prewarm: warmed %d, skipped %d, failed %d in %ss",
+                 len(warmed), len(skipped), len(failed), last_prewarm_report["seconds"])
+    return last_prewarm_report
+
+
+def start_model_prewarm(models=local_models):
+    """Runs prewarm_models on a daemon thread so startup and readiness are never blocked."""
+    if MODEL_PREWARM_MAX_MB <= 0:
+        return None
+
+    def run():
+        try:
+            prewarm_models(models=models)
+        except Exception as e:
+            logging.warning("Model prewarm failed: %s", e)
+
+    thread = threading.Thread(target=run, name="model-prewarm", daemon=True)
+    thread.start()
+    return thread
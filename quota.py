@@ -0,0 +1,243 @@
+# quota.py
+# Plan entitlements and per-client monthly AI request counters. Counters are
+# loaded once per client and month and kept in memory, so the check before
+# inference is a dict lookup; increments are persisted to ai_usage_monthly
+# by a background thread as additive deltas.
+import atexit
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import NamedTuple, Optional
+from db import add_ai_usage, get_ai_request_count, get_plan_entitlements, run_db
+
+# Seconds between counter flushes; other workers see our usage after this long
+QUOTA_FLUSH_SECONDS = float(os.getenv("QUOTA_FLUSH_SECONDS", "2"))
+# Seconds plan_entitlements is cached before it is re-read
+ENTITLEMENTS_TTL = float(os.getenv("ENTITLEMENTS_TTL", "300"))
+# Plans missing from plan_entitlements (e.g. 'free') get this plan's limits
+DEFAULT_PLAN = "demo"
+
+QUOTA_EXCEEDED_REPLY = ("This assistant has reached its monthly AI reply limit. "
+                        "Please contact the site owner or try again next month.")
+
+logger = logging.getLogger(__name__)
+
+
+class Entitlement(NamedTuple):
+    plan: str
+    max_faqs: int
+    monthly_ai_requests: Optional[int]  # None = unlimited
+
+
+# Used only if plan_entitlements has no row for DEFAULT_PLAN
+_FALLBACK = Entitlement(DEFAULT_PLAN, 5, 100)
+
+
+class Entitlements:
+    """plan -> Entitlement, read from plan_entitlements and cached with a TTL."""
+
+    def __init__(self, ttl=ENTITLEMENTS_TTL):
+        self.ttl = ttl
+        self._plans = {}
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            rows = get_plan_entitlements()
+        except Exception as e:
+            # Keep serving the previous table rather than failing chat requests
+            logger.error("Could not load plan entitlements: %s", e)
+            return
+        self._plans = {plan.lower(): Entitlement(plan.lower(), row["max_faqs"], row["monthly_ai_requests"])
+                       for plan, row in rows.items()}
+
+    def get(self, plan) -> Entitlement:
+        if time.time() - self._loaded_at >= self.ttl:
+            with self._lock:
+                if time.time() - self._loaded_at >= self.ttl:
+                    self._load()
+                    self._loaded_at = time.time()
+        plans = self._plans
+        return plans.get((plan or DEFAULT_PLAN).lower()) or plans.get(DEFAULT_PLAN) or _FALLBACK
+
+    def invalidate(self):
+        """Call after editing plan_entitlements."""
+        self._loaded_at = 0.0
+
+
+def current_month():
+    return datetime.utcnow().strftime("%Y-%m")
+
+
+class AiQuota:
+    """
+    In-memory monthly AI request counters, one per (client_id, month).
+    acquire() counts a request before it reaches the model; release() hands
+    it back if inference fails. Every cached counter is re-read from the
+    database on each flush, so other workers' usage and refunds show up
+    within QUOTA_FLUSH_SECONDS.
+    """
+
+    def __init__(self, plans, flush_seconds=QUOTA_FLUSH_SECONDS):
+        self.plans = plans
+        self.flush_interval = flush_seconds
+        self._used = {}     # {(client_id, month): persisted total + local pending}
+        self._pending = {}  # {(client_id, month): increments not yet persisted}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.allowed = 0
+        self.rejected = 0
+        self.loads = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+
+    # ----------------------------
+    # Counters
+    # ----------------------------
+    def _ensure_loaded(self, key):
+        if key in self._used:
+            return
+        persisted = get_ai_request_count(*key)
+        with self._lock:
+            if key not in self._used:
+                self._used[key] = persisted + self._pending.get(key, 0)
+                self.loads += 1
+        # Cached counters go stale without the flush thread re-reading them
+        self._started()
+
+    def usage(self, client_id):
+        """AI requests the client has used this month, including unflushed ones."""
+        key = (int(client_id), current_month())
+        self._ensure_loaded(key)
+        return self._used[key]
+
+    def limit(self, plan):
+        return self.plans.get(plan).monthly_ai_requests
+
+    def remaining(self, client_id, plan):
+        """Requests left this month, or None when the plan is unlimited."""
+        limit = self.limit(plan)
+        return None if limit is None else max(0, limit - self.usage(client_id))
+
+    def acquire(self, client_id, plan):
+        """Counts one AI request; returns False, without counting, if the plan's allowance is used up."""
+        return self.acquire_many(client_id, plan, 1) == 1
+
+    def acquire_many(self, client_id, plan, n):
+        """Counts up to n AI requests, as many as the allowance still covers; returns how many were counted."""
+        key = (int(client_id), current_month())
+        self._ensure_loaded(key)
+        limit = self.limit(plan)
+        with self._lock:
+            granted = n if limit is None else max(0, min(n, limit - self._used[key]))
+            if granted:
+                self._used[key] += granted
+                self._pending[key] = self._pending.get(key, 0) + granted
+                self.allowed += granted
+            self.rejected += n - granted
+        if granted:
+            self._started()
+        return granted
+
+    async def acquire_async(self, client_id, plan):
+        """acquire(), loading a counter not seen yet this month off the event loop."""
+        return await self.acquire_many_async(client_id, plan, 1) == 1
+
+    async def acquire_many_async(self, client_id, plan, n):
+        """acquire_many(), loading a counter not seen yet this month off the event loop."""
+        key = (int(client_id), current_month())
+        if key not in self._used:
+            await run_db(self._ensure_loaded, key)
+        return self.acquire_many(client_id, plan, n)
+
+    def release(self, client_id, n=1):
+        """Refunds n requests acquired this month that never produced a reply."""
+        key = (int(client_id), current_month())
+        with self._lock:
+            if key in self._used:
+                self._used[key] -= n
+                self._pending[key] = self._pending.get(key, 0) - n
+                self.allowed -= n
+
+    # ----------------------------
+    # Persistence
+    # ----------------------------
+    def _started(self):
+        # The thread does not survive fork(); a worker process starts its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._stop = threading.Event()
+                    self._thread = threading.Thread(target=self._run, name="quota-flush", daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Persists pending increments and refreshes every cached counter of this month from the database."""
+        self._prune()
+        month = current_month()
+        with self._lock:
+            deltas = {key: n for key, n in self._pending.items() if n}
+            self._pending = {}
+            # Zero deltas are only read back: refunds and usage from other workers
+            for key in self._used:
+                if key[1] == month:
+                    deltas.setdefault(key, 0)
+        if not deltas:
+            return
+        try:
+            totals = add_ai_usage(deltas)
+        except Exception as e:
+            with self._lock:
+                for key, n in deltas.items():
+                    if n:
+                        self._pending[key] = self._pending.get(key, 0) + n
+            self.failed_flushes += 1
+            logger.error("AI quota flush of %d counters failed: %s", len(deltas), e)
+            return
+        with self._lock:
+            for key, total in totals.items():
+                # Picks up other workers' usage; keep what arrived since the swap
+                self._used[key] = total + self._pending.get(key, 0)
+        self.flushes += 1
+
+    def _prune(self):
+        month = current_month()
+        with self._lock:
+            for key in [k for k in self._used if k[1] != month and not self._pending.get(k)]:
+                del self._used[key]
+
+    def shutdown(self):
+        """Stops the flush thread and persists what is pending."""
+        if self._pid == os.getpid():
+            self._stop.set()
+            self._thread.join(10)
+            self._pid = None
+        self.flush()
+
+    def stats(self):
+        return {
+            "counters": len(self._used),
+            "pending": sum(self._pending.values()),
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "loads": self.loads,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "flush_seconds": self.flush_interval,
+        }
+
+
+entitlements = Entitlements()
+ai_quota = AiQuota(entitlements)
+# Scripts exit without the FastAPI lifespan; don't lose their last increments
+atexit.register(ai_quota.shutdown)
@@ -0,0 +1,61 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from faq_matcher import normalize
+
+# Per-client bound and lifetime of cached chatbot replies
+REPLY_CACHE_MAX_ENTRIES = int(os.getenv("REPLY_CACHE_MAX_ENTRIES", "256"))
+REPLY_CACHE_TTL = float(os.getenv("REPLY_CACHE_TTL", "600"))  # seconds
+
+
+# ======================
+# REPLY CACHE
+# ======================
+class ReplyCache:
+    """
+    Bounded per-client LRU of chatbot replies keyed on the normalized message.
+    Every entry remembers the version it was computed against (FAQ matcher
+    version + model version); a lookup with a different version is a miss,
+    so FAQ edits and model changes invalidate a client's replies automatically.
+    """
+
+    def __init__(self, max_entries=REPLY_CACHE_MAX_ENTRIES, ttl=REPLY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clients = {}  # {client_id: OrderedDict{key: (expires_at, version, value)}}
+        self._lock = threading.Lock()
+
+    def get(self, client_id, message, version):
+        key = normalize(message)
+        with self._lock:
+            entries = self._clients.get(client_id)
+            if not entries or key not in entries:
+                return None
+            expires_at, entry_version, value = entries[key]
+            if entry_version != version or expires_at < time.monotonic():
+                del entries[key]
+                return None
+            entries.move_to_end(key)
+            return value
+
+    def put(self, client_id, message, version, value):
+        if self.max_entries <= 0:
+            return
+        key = normalize(message)
+        with self._lock:
+            entries = self._clients.setdefault(client_id, OrderedDict())
+            entries[key] = (time.monotonic() + self.ttl, version, value)
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def invalidate(self, client_id=None):
+        with self._lock:
+            if client_id is None:
+                self._clients.clear()
+            else:
+                self._clients.pop(client_id, None)
+
+
+reply_cache = ReplyCache()
@@ -1,9 +1,22 @@
-from fastapi import APIRouter, HTTPException, Request, Query
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, HTTPException, Request, Query, Depends
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 import sqlite3
 from datetime import datetime
+import asyncio
+import base64
+import csv
+import hashlib
+import io
 import json
-from db import get_db_connection, get_faq_count, get_ai_request_count, get_user_plan
+import os
+from db import (get_tenant_db, get_user_plan, get_analytics_summary, count_active_users, read_analytics_events,
+                get_ai_request_count, run_db, ANALYTICS_EVENT_COLUMNS)
+from analytics_writer import analytics_writer
+from live_metrics import metrics_hub, merge_delta
+from analytics_archive import iter_archived_events
+from identity import Identity, require_client
+from quota import entitlements, current_month
+from hll import HyperLogLog
 
 router = APIRouter()
 
@@ -26,26 +39,12 @@ async def log_event(request: Request):
     if not client_id or not event_type:
         raise HTTPException(status_code=400, detail="Missing required fields")
 
-    ts = datetime.utcnow().isoformat()
-    details_json = json.dumps(details)
-    data_json = json.dumps(extra_data)
-
     # Skip admin events
     if source != "customer":
         return {"status": "ignored", "reason": "admin event not logged"}
 
-    conn = get_db_connection()
-    try:
-        conn.execute(
-            """
-            INSERT INTO analytics (client_id, user_id, source, event_type, data, details, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            """,
-            (int(client_id), user_id, source, event_type, data_json, details_json, ts)
-        )
-        conn.commit()
-    finally:
-        conn.close()
+    await analytics_writer.log_async(int(client_id), event_type, details, user_id=user_id,
+                                     source=source, data=extra_data)
 
     return {"status": "success", "message": "Event logged"}
 
@@ -56,71 +55,268 @@ async def log_event(request: Request):
 # ----------------------------
 # GET ANALYTICS DATA (MVP version)
 # ----------------------------
+def _analytics_state(client_id):
+    """
+    Everything /analytics/data depends on that can change, from cheap lookups
+    only: event total, FAQ count, plan and its limits, AI usage and the
+    date (the 30-day window slides). Used as the ETag and to decide when to push a snapshot.
+    AI usage is the persisted ai_usage_monthly total, which every worker's quota
+    flush adds to, so all workers compute the same ETag for the same numbers.
+    """
+    conn = get_tenant_db(client_id)
+    try:
+        row = conn.execute("SELECT events FROM analytics_totals WHERE client_id=?", (client_id,)).fetchone()
+        faq_created = conn.execute("SELECT COUNT(*) FROM faqs WHERE client_id=?", (client_id,)).fetchone()[0]
+        ai_used = get_ai_request_count(client_id, current_month(), conn)
+    finally:
+        conn.close()
+    plan = get_user_plan(client_id)
+    return {
+        "events": row["events"] if row else 0,
+        "faq_created": faq_created,
+        "plan": plan,
+        "limits": list(entitlements.get(plan)),
+        "ai_used": ai_used,
+        "day": datetime.utcnow().date().isoformat(),
+    }
+
+
+def _etag(state):
+    return 'W/"' + hashlib.sha1(json.dumps(state, sort_keys=True).encode()).hexdigest()[:20] + '"'
+
+
+def _etag_matches(etag, if_none_match):
+    # If-None-Match is a comma-separated list of tags; compared weakly, so the
+    # W/ prefix is ignored on both sides, and "*" matches any current tag
+    if not if_none_match:
+        return False
+    etag = etag[2:] if etag.startswith("W/") else etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:].strip()
+        if tag == etag:
+            return True
+    return False
+
+
+def _analytics_payload(client_id, state):
+    # Totals, active users and the 30-day chart come from the rollup tables,
+    # so this costs the same however much raw history the client has
+    summary = get_analytics_summary(client_id, days=30)
+
+    # Plan limits come from the cached plan_entitlements table
+    entitlement = entitlements.get(state["plan"])
+
+    # Remaining from the same persisted usage as the ETag; null when unlimited
+    limit = entitlement.monthly_ai_requests
+    remaining_ai = None if limit is None else max(0, limit - state["ai_used"])
+
+    return {
+        "total_interactions": summary["total_interactions"],
+        "active_users": summary["active_users"],
+        "faq_usage": {"created": state["faq_created"], "limit": entitlement.max_faqs},
+        "remaining_ai_requests": {"used": state["ai_used"], "limit": remaining_ai},
+        "daily": summary["daily"],
+    }
+
+
 @router.get("/analytics/data")
-def get_analytics(client_id: int = Query(...)):
+def get_analytics(request: Request, client_id: int = Query(...)):
     if not client_id:
         raise HTTPException(status_code=400, detail="client_id required")
-    
-    conn = get_db_connection()
-    conn.row_factory = sqlite3.Row
+
+    # Conditional GET: pollers that already have the current numbers get a 304
+    # without the summary queries running
+    state = _analytics_state(client_id)
+    etag = _etag(state)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(etag, request.headers.get("if-none-match")):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(_analytics_payload(client_id, state), headers=headers)
+
+
+# ----------------------------
+# LIVE DASHBOARD (server-sent events)
+# ----------------------------
+# Seconds between checks for changes made outside this process (other
+# workers' events, FAQ edits, plan changes); same-process events push at once
+LIVE_RESYNC_SECONDS = float(os.getenv("LIVE_RESYNC_SECONDS", "15"))
+# A burst of ingests within this window is sent as one delta and one snapshot
+LIVE_COALESCE_MS = float(os.getenv("LIVE_COALESCE_MS", "500"))
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@router.get("/analytics/stream")
+async def analytics_stream(request: Request, identity: Identity = Depends(require_client)):
+    """
+    Live dashboard feed for the session client. Sends 'metrics' with the
+    /analytics/data payload on connect and whenever it changes, and 'delta'
+    ({events, event_types}) as soon as new events are written.
+    """
+    client_id = identity.client_id
+
+    async def events():
+        q = metrics_hub.subscribe(client_id)
+        etag = None
+        try:
+            while True:
+                state = await run_db(_analytics_state, client_id)
+                if _etag(state) != etag:
+                    etag = _etag(state)
+                    payload = await run_db(_analytics_payload, client_id, state)
+                    yield _sse("metrics", {"etag": etag, "data": payload})
+
+                try:
+                    delta = await asyncio.wait_for(q.get(), LIVE_RESYNC_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                await asyncio.sleep(LIVE_COALESCE_MS / 1000)
+                # Deltas are shared between subscribers; sum them into a new dict
+                total = merge_delta({"events": 0, "event_types": {}}, delta)
+                while not q.empty():
+                    merge_delta(total, q.get_nowait())
+                yield _sse("delta", total)
+        finally:
+            metrics_hub.unsubscribe(client_id, q)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@router.get("/analytics/active_users")
+def active_users(since: str = None, until: str = None, exact: bool = False,
+                 identity: Identity = Depends(require_client)):
+    """
+    Distinct users of the session client on days in [since, until) (YYYY-MM-DD).
+    Approximate by default; exact=true for billing reports.
+    """
+    count = count_active_users(identity.client_id, start=since, end=until, exact=exact)
+    return {
+        "active_users": count,
+        "exact": exact,
+        "relative_error": 0.0 if exact else round(HyperLogLog().error, 4),
+        "since": since,
+        "until": until,
+    }
+
+
+# ----------------------------
+# RAW EVENTS (paginated + export)
+# ----------------------------
+ANALYTICS_PAGE_MAX = 1000
+ANALYTICS_EXPORT_CHUNK = 1000
+
+
+def _encode_cursor(row):
+    return base64.urlsafe_b64encode(json.dumps([row["timestamp"], row["id"]]).encode()).decode()
+
+
+def _decode_cursor(cursor):
     try:
-        cur = conn.cursor()
-        
-        # Total interactions
-        cur.execute("SELECT COUNT(*) as total FROM analytics WHERE client_id=?", (client_id,))
-        total_interactions = cur.fetchone()["total"] or 0
-
-        # Active users last 30 days
-        cur.execute("""
-            SELECT COUNT(DISTINCT user_id) as users
-            FROM analytics
-            WHERE client_id=? AND datetime(timestamp) >= datetime('now', '-30 days')
-        """, (client_id,))
-        active_users = cur.fetchone()["users"] or 0
-
-        # ------------------------
-        # FAQ limit (MVP)
-        # ------------------------
-        # For MVP, define a simple fixed limit per client
-        faq_limit_per_client = 50  # change as needed
-        # Count actual FAQs created by the client
-        cur.execute("SELECT COUNT(*) as created FROM faqs WHERE client_id=?", (client_id,))
-        faq_created = cur.fetchone()["created"] or 0
-
-        # AI usage
-        used_ai = get_ai_request_count(client_id)
-        plan = (get_user_plan(client_id) or "demo").lower()
-        ai_limits = {"demo": 100, "onetime": 500, "basic": 1000, "standard": 5000, "premium": float('inf')}
-        max_ai = ai_limits.get(plan, 100)
-        remaining_ai = max_ai - used_ai if max_ai != float('inf') else float('inf')
-
-        # Daily counts
-        cur.execute("""
-            SELECT DATE(timestamp) as day,
-                   SUM(CASE WHEN event_type='faq_click' THEN 1 ELSE 0 END) as faq_count,
-                   SUM(CASE WHEN event_type='ai_request' THEN 1 ELSE 0 END) as ai_count
-            FROM analytics
-            WHERE client_id=? AND datetime(timestamp) >= datetime('now', '-30 days')
-            GROUP BY day
-            ORDER BY day
-        """, (client_id,))
-        rows = cur.fetchall()
-        daily_labels = [r["day"] for r in rows]
-        daily_faq_counts = [r["faq_count"] for r in rows]
-        daily_ai_counts = [r["ai_count"] for r in rows]
-
-        # Raw events
-        cur.execute("SELECT event_type, details, timestamp FROM analytics WHERE client_id=? ORDER BY timestamp ASC", (client_id,))
-        events = [{"event_type": r["event_type"], "details": r["details"], "timestamp": r["timestamp"]} for r in cur.fetchall()]
+        timestamp, event_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(timestamp), int(event_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _loads(value):
+    try:
+        return json.loads(value) if value else value
+    except ValueError:
+        return value
+
+
+def _event_dict(row):
+    event = dict(row)
+    event["details"] = _loads(event["details"])
+    event["data"] = _loads(event["data"])
+    return event
+
+
+@router.get("/analytics/events")
+def list_events(cursor: str = None, limit: int = Query(100, ge=1, le=ANALYTICS_PAGE_MAX),
+                event_type: str = None, since: str = None, until: str = None,
+                identity: Identity = Depends(require_client)):
+    """
+    The session client's raw events, oldest first, optionally in [since, until)
+    (ISO dates or timestamps). Pass next_cursor back as 'cursor' for the
+    following page; it is null on the last page. Archived months are only
+    available through the export.
+    """
+    after = _decode_cursor(cursor) if cursor else None
+    rows = read_analytics_events(identity.client_id, after=after, limit=limit, event_type=event_type,
+                                 start=since, end=until)
+    next_cursor = _encode_cursor(rows[-1]) if len(rows) == limit else None
+    return {"events": [_event_dict(r) for r in rows], "next_cursor": next_cursor}
+
+
+def _iter_event_pages(client_id, event_type, since, until, archived):
+    # Archived months first (they are the oldest), read from their gzip files
+    if archived:
+        page = []
+        for event in iter_archived_events(client_id, since, until, event_type):
+            page.append(event)
+            if len(page) == ANALYTICS_EXPORT_CHUNK:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    # A fresh keyset page per chunk: memory stays at one chunk, and no connection
+    # or read transaction is held while the client is slow to read
+    after = None
+    while True:
+        rows = read_analytics_events(client_id, after=after, limit=ANALYTICS_EXPORT_CHUNK, event_type=event_type,
+                                     start=since, end=until)
+        if not rows:
+            return
+        yield rows
+        if len(rows) < ANALYTICS_EXPORT_CHUNK:
+            return
+        after = (rows[-1]["timestamp"], rows[-1]["id"])
+
+
+def _ndjson_lines(*query):
+    for rows in _iter_event_pages(*query):
+        yield "".join(json.dumps(_event_dict(r)) + "\n" for r in rows)
+
+
+def _csv_lines(*query):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(ANALYTICS_EVENT_COLUMNS)
+    for rows in _iter_event_pages(*query):
+        writer.writerows(tuple(r[c] for c in ANALYTICS_EVENT_COLUMNS) for r in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
 
-    finally:
-        conn.close()
 
-    return JSONResponse({
-        "total_interactions": total_interactions,
-        "active_users": active_users,
-        "faq_usage": {"created": faq_created, "limit": faq_limit_per_client},
-        "remaining_ai_requests": {"used": used_ai, "limit": remaining_ai},
-        "daily": {"labels": daily_labels, "faq_counts": daily_faq_counts, "ai_counts": daily_ai_counts},
-        "events": events
-    })
+@router.get("/analytics/events/export")
+def export_events(format: str = "ndjson", event_type: str = None, since: str = None, until: str = None,
+                  include_archived: bool = False, identity: Identity = Depends(require_client)):
+    """
+    Streams the session client's event history as NDJSON or CSV, optionally
+    in [since, until); include_archived adds months moved to the archive.
+    """
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    client_id = identity.client_id
+    query = (client_id, event_type, since, until, include_archived)
+    if format == "csv":
+        body, media_type = _csv_lines(*query), "text/csv"
+    else:
+        body, media_type = _ndjson_lines(*query), "application/x-ndjson"
+    filename = f"analytics_{client_id}_{datetime.utcnow():%Y%m%d}.{format}"
+    return StreamingResponse(body, media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
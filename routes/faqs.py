@@ -1,6 +1,8 @@
 # routes/faqs.py
-from fastapi import APIRouter, Request, HTTPException
-from db import get_db_connection, get_db
+from fastapi import APIRouter, Request, HTTPException, Depends
+from db import get_tenant_db, run_db, save_faq_async, delete_faq_by_id_async
+from faq_matcher import faq_saved, faq_deleted
+from identity import Identity, require_client
 
 router = APIRouter()
 
@@ -8,18 +10,16 @@ router = APIRouter()
 # GET ALL FAQs (return with id)
 # -------------------------
 
-@router.get("/faq_data")
-async def faq_data(request: Request):
-    user = request.session.get("user")
-    if not user:
-        raise HTTPException(status_code=403, detail="Unauthorized")
-
-    from db import get_client_id
-    client_id = get_client_id(user["email"])
-
-    conn = get_db_connection()
+def _client_faq_rows(client_id):
+    conn = get_tenant_db(client_id)
     faqs = conn.execute("SELECT id, question, answer, popular FROM faqs WHERE client_id = ?", (client_id,)).fetchall()
     conn.close()
+    return faqs
+
+
+@router.get("/faq_data")
+async def faq_data(identity: Identity = Depends(require_client)):
+    faqs = await run_db(_client_faq_rows, identity.client_id)
 
     # Return id too
     all_faqs = {
@@ -64,17 +64,10 @@ async def delete_faq_endpoint(request: Request):
         return {"success": False, "error": "Missing client_id or faq_id"}
 
     try:
-        with get_db_connection() as conn:
-            conn.execute("DELETE FROM faqs WHERE client_id=? AND id=?", (client_id, faq_id))
-            conn.commit()
-
-            # Optional: audit logs
-            action = f"Deleted FAQ ID: {faq_id}"
-            conn.execute(
-                "INSERT INTO audit_logs (client_id, action, performed_by) VALUES (?, ?, ?)",
-                (client_id, action, None)
-            )
-            conn.commit()
+        # Deletes and writes the audit log entry in one transaction
+        question = await delete_faq_by_id_async(client_id, faq_id)
+        if question:
+            faq_deleted(client_id, question)
 
         return {"success": True, "message": f"FAQ ID {faq_id} deleted successfully"}
     except Exception as e:
@@ -111,23 +104,8 @@ async def update_faq(request: Request):
         raise HTTPException(status_code=400, detail="Missing fields")
 
     try:
-        with get_db() as conn:
-            row = conn.execute(
-                "SELECT id FROM faqs WHERE client_id=? AND question=?",
-                (client_id, question)
-            ).fetchone()
-
-            if row:
-                conn.execute(
-                    "UPDATE faqs SET answer=?, popular=? WHERE id=?",
-                    (answer, popular, row["id"])
-                )
-            else:
-                conn.execute(
-                    "INSERT INTO faqs (client_id, question, answer, popular) VALUES (?, ?, ?, ?)",
-                    (client_id, question, answer, popular)
-                )
-            conn.commit()
+        await save_faq_async(client_id, question, answer, popular)
+        faq_saved(client_id, question, answer)
 
         return {"success": True, "message": "FAQ saved successfully!"}
     except Exception as e:
@@ -0,0 +1,125 @@
+# split_shards.py
+# Moves tenant-scoped rows (db.TENANT_TABLES) from the catalog database into
+# the DB_SHARDS bucket files, to switch an existing install to sharded mode.
+# Analytics are copied partition by partition; for months already archived
+# (analytics_archive.py) only their rollup rows move, the files stay put.
+# Stop the app first. Row ids are kept, so FAQ ids seen by the UI stay valid,
+# and re-running only copies rows that are not in their shard yet.
+#
+#   python split_shards.py --shards 8            # copy and verify
+#   python split_shards.py --shards 8 --purge    # ...then delete the copied rows from the catalog
+import argparse
+import os
+import sqlite3
+import sys
+
+
+def _columns(conn, schema, table):
+    return [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def split(db, purge=False):
+    """Copies every tenant table bucket by bucket; returns {table: rows copied}."""
+    catalog = sqlite3.connect(db.DB_FILE, timeout=db.DB_BUSY_TIMEOUT_MS / 1000)
+    catalog.execute(f"PRAGMA busy_timeout={db.DB_BUSY_TIMEOUT_MS};")
+    copied = {table: 0 for table in db.TENANT_TABLES}
+    try:
+        months = [r[0] for r in catalog.execute("SELECT month FROM analytics_partitions WHERE archived_at IS NULL")]
+        archived = catalog.execute(
+            "SELECT month, archive_path FROM analytics_partitions WHERE archive_path IS NOT NULL").fetchall()
+        for index in range(db.DB_SHARDS):
+            path = db.tenant_db_file(index)  # creates the shard and its schema
+            with db.get_tenant_db(index) as conn:
+                for month in months:
+                    db.ensure_analytics_partition(conn, month)
+                # Rebuilding the shard's rollups must leave archived months alone
+                conn.executemany("UPDATE analytics_partitions SET archive_path = ? WHERE month = ?",
+                                 [(archive_path, month) for month, archive_path in archived])
+            catalog.execute("ATTACH DATABASE ? AS shard", (path,))
+            try:
+                catalog.execute("BEGIN IMMEDIATE")
+                partitions = [db.analytics_partition_table(month) for month in months]
+                tables = [t for t in db.TENANT_TABLES if t != "analytics"] + partitions
+                for table in tables:
+                    shard_columns = set(_columns(catalog, "shard", table))
+                    columns = ", ".join(c for c in _columns(catalog, "main", table) if c in shard_columns)
+                    bucket = f"client_id IS NOT NULL AND CAST(client_id AS INTEGER) % {db.DB_SHARDS} = {index}"
+
+                    before = catalog.total_changes
+                    catalog.execute(f"""
+                        INSERT OR IGNORE INTO shard.{table} ({columns})
+                        SELECT {columns} FROM main.{table} WHERE {bucket}
+                    """)
+                    copied["analytics" if table in partitions else table] += catalog.total_changes - before
+
+                    missing = catalog.execute(f"""
+                        SELECT COUNT(*) FROM main.{table} m
+                        WHERE {bucket} AND NOT EXISTS (SELECT 1 FROM shard.{table} s WHERE s.id = m.id)
+                    """).fetchone()[0]
+                    if missing:
+                        # An id already used by a different row in the shard (the app
+                        # wrote to it before the split); leave both copies for a human
+                        raise RuntimeError(f"{table}: {missing} rows for shard {index} could not be copied (id clash)")
+                    if purge:
+                        catalog.execute(f"DELETE FROM main.{table} WHERE {bucket}")
+
+                # New events get ids above every copied one
+                catalog.execute("""
+                    UPDATE shard.analytics_ids
+                    SET last_id = MAX(last_id, (SELECT last_id FROM main.analytics_ids))
+                """)
+
+                # Quota counters are not derived from events, so they are copied
+                # too; counts the app already wrote to the shard are kept
+                bucket = f"client_id % {db.DB_SHARDS} = {index}"
+                catalog.execute(f"""
+                    INSERT OR IGNORE INTO shard.ai_usage_monthly (client_id, month, requests)
+                    SELECT client_id, month, requests FROM main.ai_usage_monthly WHERE {bucket}
+                """)
+                if purge:
+                    catalog.execute(f"DELETE FROM main.ai_usage_monthly WHERE {bucket}")
+
+                # Archived months cannot be rebuilt from raw rows; carry their rollups over
+                in_archive = ("substr(day, 1, 7) IN "
+                              "(SELECT month FROM main.analytics_partitions WHERE archive_path IS NOT NULL)")
+                for rollup in ("analytics_daily", "analytics_daily_users"):
+                    catalog.execute(f"""
+                        INSERT OR IGNORE INTO shard.{rollup}
+                        SELECT * FROM main.{rollup} WHERE {bucket} AND {in_archive}
+                    """)
+                    if purge:
+                        catalog.execute(f"DELETE FROM main.{rollup} WHERE {bucket} AND {in_archive}")
+                catalog.commit()
+            except Exception:
+                catalog.rollback()
+                raise
+            finally:
+                catalog.execute("DETACH DATABASE shard")
+            # Rollups are derived data; recompute them from the rows now in the shard
+            with db.get_tenant_db(index) as conn:
+                db.rebuild_analytics_rollups(conn)
+            print(f"shard {index}: {path}", file=sys.stderr)
+        if purge:
+            with catalog:
+                db.rebuild_analytics_rollups(catalog)
+            catalog.execute("VACUUM")
+    finally:
+        catalog.close()
+    return copied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split tenant tables out of the catalog DB into shard files.")
+    parser.add_argument("--shards", type=int, default=int(os.getenv("DB_SHARDS", "0")),
+                        help="number of shard buckets (defaults to DB_SHARDS)")
+    parser.add_argument("--purge", action="store_true", help="delete copied rows from the catalog afterwards")
+    args = parser.parse_args()
+    if args.shards <= 0:
+        parser.error("--shards (or DB_SHARDS) must be > 0")
+
+    os.environ["DB_SHARDS"] = str(args.shards)
+    import db  # reads DB_SHARDS on import
+
+    for table, count in split(db, purge=args.purge).items():
+        print(f"{table}: {count} rows copied")
+    print(f"Done. Run the app with DB_SHARDS={args.shards}.")
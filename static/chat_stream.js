@@ -0,0 +1,33 @@
+// chat_stream.js
+// Shared by the chat widgets (chatbot.js, script.js), which load it with import("./chat_stream.js").
+
+// Reads the /chatbot_message/stream SSE response, calling onText with the reply so far
+export async function streamBotReply(message, onText) {
+    const res = await fetch("/chatbot_message/stream", {
+        method: "POST",
+        body: JSON.stringify({ message }),
+        headers: { "Content-Type": "application/json" },
+    });
+    if (!res.ok || !res.body) throw new Error("Chat request failed");
+
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let reply = "";
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let sep;
+        while ((sep = buffer.indexOf("\n\n")) !== -1) {
+            const raw = buffer.slice(0, sep);
+            buffer = buffer.slice(sep + 2);
+            const event = (raw.match(/^event: (.*)$/m) || [])[1];
+            const data = JSON.parse((raw.match(/^data: (.*)$/m) || [])[1] || "{}");
+            if (event === "delta") reply += data.text;
+            if (event === "done") reply = data.reply;
+            onText(reply);
+        }
+    }
+    return reply;
+}
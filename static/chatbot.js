@@ -70,25 +70,18 @@ document.addEventListener("DOMContentLoaded", () => {
             chatContainer.appendChild(userDiv);
             chatInput.value = "";
 
-            // Bot response
+            // Bot response (rendered as it streams in)
+            const botDiv = document.createElement("div");
+            botDiv.className = "bot-message";
+            chatContainer.appendChild(botDiv);
             try {
-                const res = await fetch("/get_bot_response", {
-                    method: "POST",
-                    body: JSON.stringify({ message: userMessage }),
-                    headers: { "Content-Type": "application/json" },
+                const { streamBotReply } = await import("./chat_stream.js");
+                await streamBotReply(userMessage, text => {
+                    botDiv.textContent = text;
+                    botDiv.scrollIntoView({ behavior: "smooth", block: "end" });
                 });
-                const data = await res.json();
-
-                const botDiv = document.createElement("div");
-                botDiv.className = "bot-message";
-                chatContainer.appendChild(botDiv);
-
-                await typeMessage(botDiv, data.response);
             } catch (err) {
                 console.error(err);
-                const botDiv = document.createElement("div");
-                botDiv.className = "bot-message";
-                chatContainer.appendChild(botDiv);
                 await typeMessage(botDiv, "Sorry, something went wrong.");
             }
         });
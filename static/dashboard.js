@@ -380,9 +380,9 @@ if (target.classList.contains("edit-btn")) {
       }
     });
 
-    // Load analytics for this client
+    // Load analytics for this client, then follow live updates
     loadAnalytics();
-    setInterval(loadAnalytics, 30000); // Auto-refresh every 30s
+    subscribeAnalytics();
 
     // ADD / UPDATE FAQ FORM
     addFaqForm?.addEventListener("submit", async (e) => {
@@ -587,10 +587,39 @@ viewFaqsBtn?.addEventListener("click", () => {
   async function loadAnalytics() {
     if (!window.user?.client_id) return;
     try {
+      // The response carries an ETag; the browser revalidates with
+      // If-None-Match and reuses its copy on a 304
       const res = await fetch(`/analytics/data?client_id=${window.user.client_id}`);
       if (!res.ok) throw new Error("Failed to fetch analytics data");
-      const data = await res.json();
+      renderAnalytics(await res.json());
+    } catch (err) {
+      console.error("❌ Error loading analytics:", err);
+    }
+  }
 
+  // Server push: 'metrics' carries the full /analytics/data payload whenever
+  // it changes, 'delta' the new event count as soon as events are written.
+  // Falls back to polling where EventSource is unavailable.
+  let analyticsStream = null;
+  function subscribeAnalytics() {
+    if (!window.user?.client_id || analyticsStream) return;
+    if (!window.EventSource) {
+      setInterval(loadAnalytics, 30000);
+      return;
+    }
+    analyticsStream = new EventSource("/analytics/stream");
+    analyticsStream.addEventListener("metrics", (e) => renderAnalytics(JSON.parse(e.data).data));
+    analyticsStream.addEventListener("delta", (e) => {
+      const delta = JSON.parse(e.data);
+      if (totalInteractionsElem) {
+        totalInteractionsElem.textContent = (parseInt(totalInteractionsElem.textContent, 10) || 0) + delta.events;
+      }
+    });
+    // EventSource reconnects by itself after network errors
+  }
+
+  function renderAnalytics(data) {
+    try {
       if (totalInteractionsElem) totalInteractionsElem.textContent = data.total_interactions || 0;
       if (activeUsersElem) activeUsersElem.textContent = data.active_users || 0;
 
@@ -605,12 +634,12 @@ viewFaqsBtn?.addEventListener("click", () => {
 
       if (remainingAIRequestsElem) {
         const aiUsed = data.remaining_ai_requests?.used || 0;
-        const aiLimit = data.remaining_ai_requests?.limit === Infinity ? "∞" : data.remaining_ai_requests?.limit;
+        const aiLimit = data.remaining_ai_requests?.limit ?? "∞";
         remainingAIRequestsElem.textContent = `${aiUsed} / ${aiLimit}`;
       }
 
     } catch (err) {
-      console.error("❌ Error loading analytics:", err);
+      console.error("❌ Error rendering analytics:", err);
     }
   }
 